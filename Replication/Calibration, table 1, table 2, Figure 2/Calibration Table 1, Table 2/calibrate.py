@@ -1,11 +1,8 @@
-import networkx
 import numpy
 import pandas
 import os
 from src.library import shapefile_raster_functions
-from return_contaminant import simulated_contaminants, error_formulae
-from scipy.optimize import minimize
-from src.library import graph_functions
+from src.library import graph_functions, network_functions, calibration_functions
 from config.config import DATA_DIR
 from osgeo import gdal
 
@@ -17,6 +14,8 @@ os.chdir(os.path.dirname(os.path.abspath(__file__)))
 
 # Load data
 directory = DATA_DIR
+# from European scale assessment of the potential of ozonation and activated carbon treatment to reduce
+# micropollutant emissions with wastewater. Pistocchi 2022
 primary_eff = 0.33
 secondary_eff = 0.7
 tertiary_eff = 0.92
@@ -24,25 +23,6 @@ filter_eff = 1  # excludes in-situ load.
 
 
 
-def objective_function(params, fixed):
-    k, nothing = params
-
-    # from European scale assessment of the potential of ozonation and activated carbon treatment to reduce
-    # micropollutant emissions with wastewater. Pistocchi 2022
-    gr, rl, cont, sc_nr, locs, obs, save_location, p_eff, s_eff, t_eff, f_eff = fixed
-    sim_results, discharges = simulated_contaminants(f_eff, p_eff, s_eff, t_eff, k, gr, rl, cont, sc_nr,
-                                                                   locs)
-    excretion = numpy.sum(sim_results*obs)/numpy.sum(sim_results**2)
-    sim_results *= excretion
-    error, mean_error = error_formulae(obs, sim_results, discharges, option=0, weighted=0)
-    print(error/mean_error)
-    print(params)
-    graph_functions.simple_save([error/mean_error, [k, excretion], sim_results, discharges], save_location)
-    return error
-
-
-
-
 # open the input files
 graph_location = os.path.join(directory, "river_graph.pkl")
 reference_raster_location = os.path.join(directory, "reference_raster.tif")
@@ -69,34 +49,18 @@ dis = scenario_number
 if scenario_number == "":
     RT = "RT_HR"
     dis = "flow_HR"
-try:
-    river_graph, sorted_river_list, contamination_df = graph_functions.simple_load('graph_and_sort.pkl')
-    print('the code managed to recover an older river graph. If this gives an error,'
-          ' delete the file \'graph and sort\'.pkl')
-except:
-    river_graph = graph_functions.load_selected_attributes_graph(graph_location, [RT, dis, 'basin', 'x', 'y'])
-
-    # cut river graph
-    basins = set([])
-    for location in datapoint_locations:
-        basins.add(river_graph.nodes[location]['basin'])
-
-    node_list = []
-    for node in river_graph:
-        if river_graph.nodes[node]['basin'] in basins:
-            node_list.append(node)
-
-    river_graph = networkx.subgraph(river_graph, node_list)
-    sorted_river_list = list(networkx.topological_sort(river_graph))
-
-    # cut the contamination_df to only leave those that (might) affect the observations.
-    node_df = pandas.DataFrame(node_list)
-    contamination_df = pandas.merge(contamination_df, node_df, left_on='pixel_number', right_on=0)
-    node_df = node_list = None
-    graph_functions.simple_save([river_graph.copy(), sorted_river_list, contamination_df], 'graph_and_sort.pkl')
-
-bnds = ((0, 0.05), (0, 0))
-starting_param = [0.01, 0]
+# cut the river graph to the observations and everything upstream of them. The result is cached in this directory.
+river_graph, sorted_river_list, contamination_df = graph_functions.extract_observation_network(
+    graph_location, datapoint_locations, contamination_df, [RT, dis, 'x', 'y'], cache_directory=os.getcwd())
+
+# excretion (fitted in closed form), attenuation, filtered, primary, secondary and tertiary efficacy. Only the
+# attenuation is calibrated.
+starting_param = [1, 0.01, filter_eff, primary_eff, secondary_eff, tertiary_eff]
+free_parameters = [1]
+bnds = ((0, 0.05),)
+# the loads are the population equivalents after treatment, without the pollution per plant
+network = network_functions.graph_to_network(river_graph, sorted_river_list, [RT, dis])
+calibration_df = contamination_df.assign(pollution=1)
 
 contaminant_list = ['Lumped 14',	'Lumped 21',	'Lumped 61',
                     'Atenolol', 'Carbamazepine', 'Caffeine', 'Cetirizine',
@@ -107,20 +71,17 @@ contaminant_list = ['Lumped 14',	'Lumped 21',	'Lumped 61',
 result_dataframe = pandas.DataFrame()
 result_dataframe.index = ['R^2', 'excretion', 'attenuation']
 for contaminant in contaminant_list:
-    save_location = contaminant + '.pkl'
-    observed_values = observed_df[contaminant]
-    fixed_args = [river_graph, sorted_river_list, contamination_df, scenario_number, datapoint_locations,
-                  observed_values, save_location, primary_eff, secondary_eff, tertiary_eff, filter_eff]
-    res = minimize(objective_function, numpy.array(starting_param),
-           args=(fixed_args), method="Nelder-Mead", bounds=bnds)
-    calibration_information = graph_functions.simple_load(save_location)
+    observed_values = observed_df[contaminant].to_numpy()
+    res = calibration_functions.calibrate(network, calibration_df, datapoint_locations, observed_values,
+                                          starting_param, free_parameters, bnds, scenario_number, weighted=0)
+    print(contaminant, 1 - res['error'] / res['mean_error'], res['parameters'][:2])
     # create shapefile
     if not suppress_shapefile_raster_creation:
-        discharges = calibration_information[3]
+        discharges = res['discharges']
         discharges_norm = discharges / numpy.mean(discharges)
         dataframe = pandas.DataFrame()
         dataframe['locations'] = observed_df['locations']
-        dataframe['Prediction'] = calibration_information[2]
+        dataframe['Prediction'] = res['simulated']
         dataframe['Observations'] = observed_values
         dataframe['discharge'] = discharges
         dataframe['Longitude'] = observed_df['longitude']
@@ -135,15 +96,18 @@ for contaminant in contaminant_list:
         if contaminant == 'Lumped 14':
             shapefile_raster_functions.csv_to_shapefile(dataframe, reference_raster_location, output_name=os.path.join(DATA_DIR, contaminant, contaminant + ".shp"), options=False)
         
-        run_parameters = [calibration_information[1][1], calibration_information[1][0], filter_eff, primary_eff,
-                          secondary_eff, tertiary_eff]
-        river_graph = graph_functions.run_model(river_graph, sorted_river_list, contamination_df, run_parameters)
-        graph_functions.print_graph(river_graph, ["concentration", "flow_HR"], reference_raster_location,
-                    contaminant + ".tif")
-
-    result_dataframe[contaminant] = [1 - calibration_information[0], calibration_information[1][1],
-                                         calibration_information[1][0]]
-    os.remove(save_location)
-
+    result_dataframe[contaminant] = [1 - res['error'] / res['mean_error'], res['parameters'][0],
+                                     res['parameters'][1]]
+
+# run all calibrated contaminants together, each with its own excretion and attenuation, and print the rasters
+if not suppress_shapefile_raster_creation:
+    pollution = pandas.DataFrame({contaminant: contamination_df["pollution"] for contaminant in contaminant_list})
+    run_parameters = [result_dataframe.loc['excretion'].to_numpy(), result_dataframe.loc['attenuation'].to_numpy(),
+                      filter_eff, primary_eff, secondary_eff, tertiary_eff]
+    river_graph = graph_functions.run_model(river_graph, sorted_river_list, contamination_df, run_parameters,
+                                            pollution=pollution)
+    for contaminant in contaminant_list:
+        graph_functions.print_graph(river_graph, ["concentration " + contaminant, "flow_HR"],
+                                    reference_raster_location, contaminant + ".tif")
 
 result_dataframe.to_csv(output_name)
\ No newline at end of file
@@ -1,9 +1,13 @@
 import numpy
-import math
 import networkx
 
+from src.library import network_functions
+
+
 def simulated_contaminants(filtered_efficacy, primary_efficacy, secondary_efficacy, tertiary_efficacy, k_dec,
                            river_graph, sorted_river_list, contamination_df, scenario_number, datapoint_locations):
+    # river_graph may also be a network created by network_functions.graph_to_network, which avoids converting the
+    # graph at every call. In that case nothing is written to a graph.
     # contamination
     treatment_efficacy = primary_efficacy * (contamination_df["Treatment_level"] == 1) + secondary_efficacy * \
                          (contamination_df["Treatment_level"] == 2) + tertiary_efficacy * \
@@ -11,7 +15,6 @@ def simulated_contaminants(filtered_efficacy, primary_efficacy, secondary_effica
     # formula
     contamination = (1 - treatment_efficacy) * contamination_df["Treat_a"] + (1 - filtered_efficacy)\
                     * contamination_df["Filt_a"] + contamination_df["Unfilt_a"]
-    location = contamination_df["pixel_number"]
 
     cont = "Contaminant " + scenario_number
     RT = "RT " + scenario_number
@@ -23,27 +26,48 @@ def simulated_contaminants(filtered_efficacy, primary_efficacy, secondary_effica
         RT = "RT_HR"
         dis = "flow_HR"
         rel_cont = "Relative Contaminant"
-    networkx.set_node_attributes(river_graph, 0, name=cont)
-
-    for i in range(len(contamination_df)):
-        pixel_number = location[i]
-        river_graph.nodes[pixel_number][cont] += contamination[i]
-    RT_min = 0
-    for n in sorted_river_list:  # for all river pixels
-        # Add the contamination of the parent cells
-        parents = list(river_graph.predecessors(n))
-        for k in parents:
-            river_graph.nodes[n][cont] += river_graph.nodes[k][cont]
-        river_graph.nodes[n][cont] *= math.exp((-k_dec * river_graph.nodes[n][RT]))
-        river_graph.nodes[n][rel_cont] = river_graph.nodes[n][cont] / river_graph.nodes[n][dis]
-
-
-    results = numpy.zeros([len(datapoint_locations)])
-    discharges = numpy.zeros([len(datapoint_locations)])
-    for i in range(len(datapoint_locations)):
-        results[i] = river_graph.nodes[datapoint_locations[i]][rel_cont]
-        discharges[i] = river_graph.nodes[datapoint_locations[i]][dis]
 
+    if isinstance(river_graph, networkx.DiGraph):
+        network = network_functions.graph_to_network(river_graph, sorted_river_list, [RT, dis])
+    else:
+        network = river_graph
+
+    initial_load = network_functions.initial_loads(network, contamination_df, contamination.to_numpy())
+    load = network_functions.propagate(network, initial_load, numpy.exp(-k_dec * network[RT]))
+    concentration = load / network[dis]
+    if isinstance(river_graph, networkx.DiGraph):
+        network_functions.network_to_graph(river_graph, network, {cont: load, rel_cont: concentration})
+
+    datapoint_index = network_functions.pixels_to_index(network, datapoint_locations)
+    results = concentration[datapoint_index]
+    discharges = network[dis][datapoint_index]
+
+    return results, discharges
+
+
+def simulated_contaminants_batch(parameter_matrix, network, contamination_df, scenario_number, datapoint_locations):
+    # runs all rows [filtered_efficacy, primary_efficacy, secondary_efficacy, tertiary_efficacy, k_dec] of
+    # parameter_matrix at once, with the loads of simulated_contaminants (no pollution and no excretion). network is
+    # created by network_functions.graph_to_network. Results have a column per parameter vector.
+    RT = "RT " + scenario_number
+    dis = "discharge " + scenario_number
+    if scenario_number == "":
+        RT = "RT_HR"
+        dis = "flow_HR"
+
+    parameter_matrix = numpy.atleast_2d(numpy.asarray(parameter_matrix, dtype=numpy.float64))
+    filtered_efficacy, primary_efficacy, secondary_efficacy, tertiary_efficacy, k_dec = parameter_matrix.T
+    model_parameters = numpy.column_stack([numpy.ones(len(parameter_matrix)), k_dec, filtered_efficacy,
+                                           primary_efficacy, secondary_efficacy, tertiary_efficacy])
+    contamination = network_functions.load_classes(contamination_df.assign(pollution=1)) @ \
+        network_functions.class_coefficients(model_parameters)
+    initial_load = network_functions.initial_loads(network, contamination_df, contamination)
+    load = network_functions.propagate(network, initial_load, numpy.exp(-numpy.outer(network[RT], k_dec)))
+    concentration = load / network[dis][:, None]
+
+    datapoint_index = network_functions.pixels_to_index(network, datapoint_locations)
+    results = concentration[datapoint_index]
+    discharges = network[dis][datapoint_index]
 
     return results, discharges
 
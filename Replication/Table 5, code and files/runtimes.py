@@ -7,6 +7,7 @@ from time import time
 from src.library import graph_functions
 from src.library import shapefile_raster_functions
 from src.library import matrix_functions
+from src.library import network_functions
 from src.library.graph_functions import simple_load
 import sys
 from config.config import DATA_DIR
@@ -75,22 +76,59 @@ cont_df = pandas.read_csv(contamination_df_location)
 basin_index = basin_ids.index(9722)
 basin_matrices, pixels_df = matrix_functions.matrix_subset_sparse(
     basin_matrices_location, [9722], basin_nodes[basin_index], basin_ids, cut_size=5000)
-basin_matrices = matrix_functions.create_attenuation_matrices_sparse(basin_matrices, parameters[1])
+# the attenuation matrices are kept per attenuation, the residence time matrices are not changed
+attenuation_cache = matrix_functions.AttenuationCache(basin_matrices)
+attenuation_matrices = attenuation_cache[parameters[1]]
 ts = simple_load(topological_sort_location)
 cont_basin_df = pandas.merge(pandas.DataFrame(WWTP_per_basin[basin_index]), cont_df, left_on=0, right_on='pixel_number')
 pixels_df['init_cont'] = 0
 for row in range(len(cont_basin_df)):
     pixels_df['init_cont'].loc[cont_basin_df['pixel_number'].iloc[row]] += cont_basin_df['pollution'].iloc[row]
 initial_contaminant = numpy.array(pixels_df['init_cont'])
+positions = matrix_functions.basin_matrix_positions(attenuation_matrices, basin_nodes[basin_index])
 runtimes.append(time() - current_time)
 
 # run
 current_time = time()
 for i in range(iterations):
-    matrix_functions.run_basin_matrices_sparse(basin_matrices, basin_nodes[basin_index], initial_contaminant)
+    matrix_functions.run_basin_matrices_sparse(attenuation_matrices, basin_nodes[basin_index], initial_contaminant,
+                                               positions)
+runtimes.append((time() - current_time)/iterations)
+
+# attenuation sweep, as in a calibration: every iteration revisits the same attenuations, which come from the cache
+# after the first iteration instead of being recomputed from the residence time matrices
+attenuations = parameters[1] * numpy.array([0.5, 0.75, 1, 1.25, 1.5])
+current_time = time()
+for i in range(iterations):
+    for attenuation in attenuations:
+        matrix_functions.run_basin_matrices_sparse(attenuation_cache[attenuation], basin_nodes[basin_index],
+                                                   initial_contaminant, positions)
+runtimes.append((time() - current_time)/(iterations * len(attenuations)))
+
+# sparse triangular system implementation
+basin_matrices = attenuation_matrices = attenuation_cache = None
+# overhead
+current_time = time()
+basin_nodes, basin_ids = simple_load(ordered_basins_location)
+WWTP_per_basin = simple_load(wwtp_per_basin_location)
+cont_df = pandas.read_csv(contamination_df_location)
+river_graph = graph_functions.load_selected_attributes_graph(graph_location, ['flow_HR', 'RT_HR'])
+
+basin_index = basin_ids.index(9722)
+network = network_functions.graph_to_network(river_graph, basin_nodes[basin_index])
+river_graph = None
+cont_basin_df = pandas.merge(pandas.DataFrame(WWTP_per_basin[basin_index]), cont_df, left_on=0, right_on='pixel_number')
+system = matrix_functions.network_to_system(network, parameters[1])
+initial_contaminant = network_functions.initial_loads(network, cont_basin_df, cont_basin_df['pollution'].to_numpy())
+runtimes.append(time() - current_time)
+
+# run
+current_time = time()
+for i in range(iterations):
+    matrix_functions.solve_system(system, initial_contaminant)
 runtimes.append((time() - current_time)/iterations)
 
 runtimes_df = pandas.DataFrame(runtimes)
 runtimes_df.index = ['overhead_full', 'runtime_full', 'overhead_partial', 'runtime_partial', 'overhead_matrix',
-                     'runtime_matrix']
+                     'runtime_matrix', 'runtime_matrix_sweep', 'overhead_system', 'runtime_system']
 runtimes_df.to_csv('runtimes.csv')
\ No newline at end of file
@@ -6,6 +6,7 @@ import pickle
 import os
 import geopandas
 from src.library import graph_functions as gf
+from src.library import network_functions, store_functions
 from time import time
 
 directory = os.path.join(os.getcwd(), 'data')
@@ -33,6 +34,9 @@ indicator_location = os.path.join(directory, "3s_rivers.tif")
 
 # output files
 graph_location = os.path.join(directory, "river_graph.pkl")
+# the same graph as a memory mapped model store. The scripts that change fields of river_graph.pkl later on (6.4, 8.1
+# and 8.3. add scenarios) also write those fields to the store.
+graph_store_location = os.path.join(directory, "river_graph")
 topological_sort_location = os.path.join(directory, "sorted_river_list.pkl")
 rivers_15s_location = os.path.join(directory, "15s_rivers.tif")
 rivers_from_graph_location = os.path.join(directory, "rivers_from_graph.tif")
@@ -174,6 +178,10 @@ open_file.close()
 open_file = open(topological_sort_location, "wb")
 pickle.dump(sorted_graph, open_file)
 open_file.close()
+network = store_functions.graph_to_node_table(river_graph, sorted_river_list=sorted_graph)
+network_functions.add_travel_time_index(network)  # travel times to the outlet, see network_functions.loads_at_nodes
+store_functions.network_to_store(network, graph_store_location)
+network = None
 # deleting temporary output
 river_id = None
 lakes_raster = None
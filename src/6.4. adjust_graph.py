@@ -7,6 +7,7 @@ from src.library import graph_functions
 directory = os.path.join(os.getcwd(), 'data')
 
 graph_location = os.path.join(directory, "river_graph.pkl")
+graph_store_location = os.path.join(directory, "river_graph")  # the model store of 3. shapefile to graph.py
 topological_sort_location = os.path.join(directory, "sorted_river_list.pkl")
 adjustments_location = os.path.join(directory, "Raw data/water_fix.csv")
 contamination_df_location = os.path.join(directory, "AGG_WWTP_df.csv")
@@ -26,3 +27,5 @@ graph_functions.simulate_waste_water(river_graph, contamination_df, sorted_river
 open_file = open(graph_location, "wb")
 pickle.dump(river_graph, open_file)
 open_file.close()
+if os.path.isdir(graph_store_location):
+    graph_functions.save_to_main_graph(river_graph, graph_store_location, ['flow_HR', 'additional water'])
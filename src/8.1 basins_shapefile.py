@@ -15,6 +15,7 @@ directory = os.path.join(os.getcwd(), 'data')
 # input files
 direction_raster_location = os.path.join(directory, "15s_directions.tif")  # directions hydroRIVERS shapefile
 graph_location = os.path.join(directory, 'river_graph.pkl')
+graph_store_location = os.path.join(directory, 'river_graph')  # the model store of 3. shapefile to graph.py
 
 # output files
 basins_raster_location = os.path.join(directory, "connected_basins.tif")
@@ -78,6 +79,8 @@ out_ds = None
 open_file = open(graph_location, "wb")
 pickle.dump(river_graph, open_file)
 open_file.close()
+if os.path.isdir(graph_store_location):
+    graph_functions.save_to_main_graph(river_graph, graph_store_location, ['basin'])
 
 #  get raster datasource
 src_ds = gdal.Open(basins_raster_location)
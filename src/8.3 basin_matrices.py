@@ -12,7 +12,9 @@ graph_location = os.path.join(directory, 'river_graph.pkl')
 ordered_basins_location = os.path.join(directory, "ordered_basins.pkl")
 
 # output files
+# sparse csc matrices; matrix_functions.dense_basin_matrices converts them for the dense matrix functions
 basin_matrices_location = os.path.join(directory, "basin_matrices.pkl")
+basin_matrices_directory = os.path.join(directory, "basin_matrices")
 
 open_graph = open(graph_location, "rb")
 river_graph = pickle.load(open_graph)
@@ -22,4 +24,7 @@ open_file = open(ordered_basins_location, "rb")
 basin_list, basin_ids = pickle.load(open_file)
 open_file.close()
 
-matrix_functions.graph_to_RT_matrix(river_graph, basin_list, cut_size=800, output_location=basin_matrices_location)
+basin_matrices = matrix_functions.graph_to_RT_matrix_sparse(river_graph, basin_list, cut_size=800,
+                                                            output_location=basin_matrices_location)
+# a file per matrix, such that matrix_subset_sparse can read only the basins it needs
+matrix_functions.save_basin_matrices(basin_matrices, basin_matrices_directory)
@@ -11,6 +11,7 @@ directory = os.path.join(os.getcwd(), 'data')
 
 # input
 river_graph_location = os.path.join(directory, "river_graph.pkl")
+graph_store_location = os.path.join(directory, "river_graph")  # the model store of 3. shapefile to graph.py
 
 # parameters
 # model = 'csc_mpi'  # csc_mpi, rac_hadgem, rca4_hadgem, rca4_mpi
@@ -83,5 +84,8 @@ if loaded_graph:
     open_file = open(os.path.join(directory, graph_scenarios_location), "wb")
     pickle.dump(river_graph, open_file)
     open_file.close()
+    if os.path.isdir(graph_store_location):
+        graph_functions.save_to_main_graph(river_graph, graph_store_location,
+                                           scen_names + ['RT_' + scen_name for scen_name in scen_names])
 
     print("Graph has been saved in graph with scenarios.pkl file.")
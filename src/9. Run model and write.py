@@ -1,32 +1,41 @@
-import math
 import os
-import networkx
-import numpy
 import pandas
 import pickle
-import matplotlib.pyplot as plt
-import time
+
+from src.library import network_functions, store_functions
 
 # Load data
 directory = os.path.join(os.getcwd(), 'data')
 directory2 = os.path.join(os.getcwd(), 'reusults')
 
-# output
-written_model_location = os.path.join(directory2, "written_model.pkl")
+# output: a directory with the results per pixel_number, see store_functions.read_results
+written_model_location = os.path.join(directory2, "written_model")
 
 # open the input files
 graph_location = os.path.join(directory, "river_graph.pkl")
+# the graph of 8.3. add scenarios in graph.py, with the RT and the discharge of the flow scenarios
+scenario_graph_location = os.path.join(directory, "graph with scenarios csc_mpi 1 2 3 5 6 8 9.pkl")
 topological_sort_location = os.path.join(directory, "sorted_river_list.pkl")
 reference_raster_location = os.path.join(directory, "reference_raster.tif")
 contamination_df_location = os.path.join(directory, "AGG_WWTP_df_all_adapted.csv")
-scenarios = ['']
+# the flow scenarios to summarise, e.g. ['flow1', 'flow2', 'flow3', 'flow5', 'flow6', 'flow8', 'flow9'] of
+# 8.3. add scenarios in graph.py. They are read from scenario_graph_location.
+scenarios = []
+concentration_limit = None  # e.g. an environmental quality standard, adds the exceedance per node
+write_scenarios = False  # also write the load and concentration of every scenario
 
 contamination_df = pandas.read_csv(contamination_df_location)
 
-open_graph = open(graph_location, "rb")
-river_graph = pickle.load(open_graph)
-river_graph = river_graph[0]
-open_graph.close()
+if scenarios:
+    # 8.3. add scenarios in graph.py saves the graph itself
+    open_graph = open(scenario_graph_location, "rb")
+    river_graph = pickle.load(open_graph)
+    open_graph.close()
+else:
+    open_graph = open(graph_location, "rb")
+    river_graph = pickle.load(open_graph)
+    river_graph = river_graph[0]
+    open_graph.close()
 
 open_ts = open(topological_sort_location, "rb")
 sorted_river_list = pickle.load(open_ts)
@@ -36,49 +45,24 @@ open_ts.close()
 k_dec, filt_eff, s_eff, t_eff = [0.00995203, 0.99993389, 0.63221308, 0.81011981]
 beta_0 = 5.01466473
 
-gr, rl, cont = [river_graph, sorted_river_list, contamination_df]
-
-for scenario_number in scenarios:
-    # contamination
-    treatment_efficacy = 0.3 * (contamination_df["Treatment_level"] == 1) + s_eff * \
-                         (contamination_df["Treatment_level"] == 2) + t_eff * \
-                         (contamination_df["Treatment_level"] == 3)
-    # formula
-    contamination = (1 - treatment_efficacy) * contamination_df["Treat_a"] + (1 - filt_eff) \
-                    * contamination_df["Filt_a"] + contamination_df["Unfilt_a"]
-    contamination *= contamination_df["pollution"] * beta_0
-    location = contamination_df["pixel_number"]
-
-    cont = "Contaminant " + scenario_number
-    RT = "RT " + scenario_number
-    dis = "discharge " + scenario_number
-    rel_cont = "Relative contaminant " + scenario_number
-    initial_cont = "Initial contaminant"
-
-    if scenario_number == "":
-        cont = "Contaminant"
-        RT = "RT_HR"
-        dis = "flow_HR"
-        rel_cont = "Relative Contaminant"
-    networkx.set_node_attributes(river_graph, 0, name=cont)
-    networkx.set_node_attributes(river_graph, 0, name=initial_cont)
+parameters = [beta_0, k_dec, filt_eff, 0.3, s_eff, t_eff]
 
-    for i in range(len(contamination_df)):
-        pixel_number = location[i]
-        river_graph.nodes[pixel_number][cont] += contamination[i]
-        river_graph.nodes[pixel_number][initial_cont] = river_graph.nodes[pixel_number][cont]
+# hydroRIVERS discharge
+network = network_functions.graph_to_network(river_graph, sorted_river_list,
+                                             ['RT_HR', 'flow_HR'] + ['RT_' + s for s in scenarios] + scenarios)
+river_graph = sorted_river_list = None
+load, concentration = network_functions.run_model(network, contamination_df, parameters)
+fields = {"Contaminant": load, "Relative Contaminant": concentration}
 
-    for n in sorted_river_list:  # for all river pixels
-        # Add the contamination of the parent cells
-        parents = list(river_graph.predecessors(n))
-        for k in parents:
-            river_graph.nodes[n][cont] += river_graph.nodes[k][cont]
-            try:
-                river_graph.nodes[n][cont] *= math.exp(-k_dec * river_graph.nodes[n][RT])
-            except:
-                river_graph.nodes[n][cont] = 0
-        river_graph.nodes[n][rel_cont] = river_graph.nodes[n][cont] / river_graph.nodes[n][dis]
+# all flow scenarios in one pass. Only the mean, min, max and exceedance over the scenarios are written.
+if scenarios:
+    scenario_load, scenario_concentration = network_functions.run_scenarios(network, contamination_df, parameters,
+                                                                            scenarios)
+    fields.update(network_functions.scenario_summary(scenario_concentration, concentration_limit))
+    if write_scenarios:
+        for j, scenario in enumerate(scenarios):
+            cont, RT, dis, rel_cont = network_functions.scenario_fields(scenario)
+            fields[cont] = scenario_load[:, j]
+            fields[rel_cont] = scenario_concentration[:, j]
 
-open_file = open(written_model_location, "wb")
-pickle.dump(river_graph, open_file)
-open_file.close()
+store_functions.write_results(written_model_location, network['pixel_number'], fields)
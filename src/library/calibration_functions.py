@@ -0,0 +1,170 @@
+import numpy
+import pandas
+from scipy.optimize import minimize
+
+from src.library import network_functions
+
+
+def observation_error(observations, simulated, discharges, weighted: int = 1) -> list:
+    """
+     Calculates the squared error of the simulated concentrations at the observations, as error_formulae with
+     option 0 in return_contaminant.py.
+     :rtype: list
+     :observations: array-like: the observed concentration at every datapoint.
+     :simulated: array-like: the simulated concentration at every datapoint.
+     :discharges: array-like: the discharge at every datapoint.
+     :weighted: int: if 1, the errors are weighted by the discharge.
+     :return: the mean squared error and the mean squared error of the mean of the observations.
+     """
+    observations = numpy.asarray(observations, dtype=numpy.float64)
+    weights = numpy.asarray(discharges, dtype=numpy.float64) if weighted == 1 else numpy.ones(len(observations))
+    error = numpy.mean(weights * numpy.square(observations - numpy.asarray(simulated, dtype=numpy.float64)))
+    weighted_observations = observations * numpy.sqrt(weights)
+    mean_error = numpy.mean(numpy.square(weighted_observations - numpy.mean(weighted_observations)))
+    return [error, mean_error]
+
+
+def adjoint_sweep(network: dict, seed: numpy.ndarray, decay: numpy.ndarray = None) -> numpy.ndarray:
+    """
+     Propagates sensitivities upstream, the reverse of network_functions.propagate. With g the derivative of an
+     objective to the load of every node, the derivative to the initial load of node n is
+     mu_n = decay_n * (g_n + mu_child). The levels are handled from the deepest one up, so all nodes of a level are
+     handled at once.
+     :rtype: numpy.ndarray
+     :network: dict: the network created by network_functions.graph_to_network.
+     :seed: numpy.ndarray: the derivative of the objective to the load of every node, zero for most nodes.
+     :decay: numpy.ndarray: the fraction of the load that remains after passing a node. If None, nothing decays.
+     :return: an array with the derivative of the objective to the initial load of every node.
+     """
+    sensitivity = numpy.array(seed, dtype=numpy.float64)
+    child = network['child']
+    level_pointer = network['level_pointer']
+
+    for level in range(len(level_pointer) - 2, -1, -1):
+        start, end = level_pointer[level], level_pointer[level + 1]
+        children = child[start:end]
+        has_child = children >= 0
+        # children are always in a later level, so their sensitivity is final.
+        sensitivity[start:end][has_child] += sensitivity[children[has_child]]
+        if decay is not None:
+            sensitivity[start:end] *= decay[start:end]
+    return sensitivity
+
+
+def observation_gradient(network: dict, contamination_df: pandas.DataFrame, parameters: list, datapoint_locations,
+                         observations, scenario: str = '', weighted: int = 1, fit_excretion: bool = False) -> dict:
+    """
+     Calculates the error of observation_error and its gradient to the load of every plant, to the attenuation and to
+     the parameters, with one run of the model and one adjoint_sweep, instead of a run for every plant or parameter.
+     :rtype: dict
+     :network: dict: the network created by network_functions.graph_to_network. It must contain the residence time
+     and discharge fields of the scenario.
+     :contamination_df: pandas.DataFrame: A dataframe of contamination containing the discharge points.
+     :parameters: list: A list of the parameters in the model, including excretion, attenuation, filtered efficacy,
+                        primary efficacy, secondary efficacy and tertiary efficacy.
+     :datapoint_locations: array-like: the pixel number of every observation.
+     :observations: array-like: the observed concentration at every datapoint.
+     :scenario: string: the scenario to be run. The default gives the hydroRIVERS scenario.
+     :weighted: int: if 1, the errors are weighted by the discharge, see observation_error.
+     :fit_excretion: bool: if True, the excretion is replaced by the excretion with the smallest error, which follows
+     in closed form because the loads are linear in the excretion. The error is then minimal in the excretion, so the
+     gradient to the other parameters is also the gradient of the error with the best excretion.
+     :return: a dictionary with the 'excretion', the 'error' and 'mean_error' of observation_error, the 'simulated'
+     concentration and the 'discharges' at the datapoints, the derivative of the error to the load of every row of
+     contamination_df ('plant'), to the initial load of every node ('initial_load'), to the attenuation
+     ('attenuation') and to every parameter in the order of parameters ('parameters').
+     """
+    cont, RT, dis, rel_cont = network_functions.scenario_fields(scenario)
+    residence_time = numpy.asarray(network[RT], dtype=numpy.float64)
+    discharge = numpy.asarray(network[dis], dtype=numpy.float64)
+    decay = numpy.exp(-parameters[1] * residence_time)
+
+    plant_index = network_functions.table_to_index(network, contamination_df)
+    plant_load = network_functions.plant_loads(contamination_df, parameters)
+    initial_load = numpy.bincount(plant_index, weights=plant_load, minlength=len(decay))
+    load = network_functions.propagate(network, initial_load, decay)
+
+    observations = numpy.asarray(observations, dtype=numpy.float64)
+    datapoint_index = network_functions.pixels_to_index(network, datapoint_locations)
+    simulated = load[datapoint_index] / discharge[datapoint_index]
+    discharges = discharge[datapoint_index]
+    weights = discharges if weighted == 1 else numpy.ones(len(observations))
+    excretion = parameters[0]
+    if fit_excretion:
+        scale = numpy.sum(weights * simulated * observations) / numpy.sum(weights * simulated ** 2)
+        excretion, load, simulated = excretion * scale, load * scale, simulated * scale
+    error, mean_error = observation_error(observations, simulated, discharges, weighted)
+
+    # the derivative of the error to the load of the nodes with an observation
+    seed = numpy.bincount(datapoint_index, weights=-2 * weights * (observations - simulated) /
+                          (len(observations) * discharges), minlength=len(decay))
+    sensitivity = adjoint_sweep(network, seed, decay)
+
+    # the load of a node is decay * (initial load + parent loads), so d load / d attenuation = -RT * load and the
+    # sensitivity of the load itself is seed + the sensitivity of the initial load of the child.
+    child = network['child']
+    load_sensitivity = seed + numpy.where(child >= 0, sensitivity[numpy.maximum(child, 0)], 0)
+    attenuation_gradient = -numpy.sum(residence_time * load * load_sensitivity)
+
+    # the plant loads are the load classes times the coefficients of network_functions.class_coefficients
+    plant_gradient = sensitivity[plant_index]
+    class_gradient = plant_gradient @ network_functions.load_classes(contamination_df)
+    unit_parameters = [1] + list(parameters[1:])
+    parameter_gradient = numpy.array([class_gradient @ network_functions.class_coefficients(unit_parameters)[:, 0],
+                                      attenuation_gradient, -excretion * class_gradient[4],
+                                      -excretion * class_gradient[1], -excretion * class_gradient[2],
+                                      -excretion * class_gradient[3]])
+
+    return {'excretion': excretion, 'error': error, 'mean_error': mean_error, 'simulated': simulated,
+            'discharges': discharges, 'plant': plant_gradient, 'initial_load': sensitivity,
+            'attenuation': attenuation_gradient, 'parameters': parameter_gradient}
+
+
+def calibrate(network: dict, contamination_df: pandas.DataFrame, datapoint_locations, observations, parameters: list,
+              free_parameters: list, bounds: list, scenario: str = '', weighted: int = 1, fit_excretion: bool = True,
+              options: dict = None) -> dict:
+    """
+     Calibrates the parameters to the observations with L-BFGS-B. Every evaluation gives the error and its gradient
+     with one run of the model and one adjoint_sweep, see observation_gradient, and the excretion follows in closed
+     form, so only the other parameters are searched.
+     :rtype: dict
+     :network: dict: the network created by network_functions.graph_to_network. It must contain the residence time
+     and discharge fields of the scenario.
+     :contamination_df: pandas.DataFrame: A dataframe of contamination containing the discharge points.
+     :datapoint_locations: array-like: the pixel number of every observation.
+     :observations: array-like: the observed concentration at every datapoint.
+     :parameters: list: the starting parameters [excretion, attenuation, filt_eff, primary_eff, secondary_eff,
+     tertiary_eff]. Parameters that are not free keep their value.
+     :free_parameters: list: the positions in parameters of the calibrated parameters, e.g. [1, 4] for the attenuation
+     and the secondary efficacy.
+     :bounds: list: a (minimum, maximum) pair for every free parameter.
+     :scenario: string: the scenario to be run. The default gives the hydroRIVERS scenario.
+     :weighted: int: if 1, the errors are weighted by the discharge, see observation_error.
+     :fit_excretion: bool: if True, the excretion is fitted in closed form at every evaluation. It should then not be
+     a free parameter.
+     :options: dict: the options of scipy.optimize.minimize.
+     :return: a dictionary with the calibrated 'parameters', the 'error', 'mean_error', 'simulated' and 'discharges'
+     of observation_gradient for these parameters, and the 'evaluations', 'success' and 'message' of the optimizer.
+     """
+    parameters = list(parameters)
+    free_parameters = list(free_parameters)
+
+    def objective(values):
+        for position, value in zip(free_parameters, values):
+            parameters[position] = value
+        result = observation_gradient(network, contamination_df, parameters, datapoint_locations, observations,
+                                      scenario, weighted, fit_excretion)
+        return result['error'], result['parameters'][free_parameters]
+
+    start = [parameters[position] for position in free_parameters]
+    optimum = minimize(objective, numpy.array(start, dtype=numpy.float64), jac=True, method='L-BFGS-B',
+                       bounds=bounds, options=options)
+
+    for position, value in zip(free_parameters, optimum.x):
+        parameters[position] = value
+    result = observation_gradient(network, contamination_df, parameters, datapoint_locations, observations, scenario,
+                                  weighted, fit_excretion)
+    parameters[0] = result['excretion']
+    return {'parameters': parameters, 'error': result['error'], 'mean_error': result['mean_error'],
+            'simulated': result['simulated'], 'discharges': result['discharges'], 'evaluations': optimum.nfev,
+            'success': optimum.success, 'message': optimum.message}
@@ -1,10 +1,13 @@
 import os
+import hashlib
 import progressbar
 import numpy
 import math
 import networkx
 import pandas
 import src.library.shapefile_raster_functions as shapefile_raster_functions
+import src.library.network_functions as network_functions
+import src.library.store_functions as store_functions
 from osgeo import gdal
 from time import time
 import pickle
@@ -106,33 +109,17 @@ def simulate_waste_water(graph_location: object, contamination_df: pandas.DataFr
 
     # add water to the initial discharge points
     person_equivalents = contamination_df['Treat_a'] + contamination_df['Unfilt_a']
-    networkx.set_node_attributes(river_graph, 0, name='additional water')
-
-    for i in range(len(contamination_df)):
-        river_graph.nodes[contamination_df['pixel_number'][i]]['additional water'] += \
-            cubic_meter_hour * person_equivalents[i]
+    network = network_functions.graph_to_network(river_graph, list(sorted_river), ['flow_HR'])
+    additional_water = network_functions.initial_loads(network, contamination_df,
+                                                       cubic_meter_hour * person_equivalents.to_numpy())
 
     # propogate the water
-    for n in sorted_river:
-        parents = list(river_graph.predecessors(n))
-        for k in parents:
-            river_graph.nodes[n]['additional water'] += river_graph.nodes[k]['additional water']
-
-    # calculate the total discharge
-    additional_water = list(networkx.get_node_attributes(river_graph, 'additional water').items())
-    additional_water = numpy.array(additional_water)
-    additional_water = additional_water[:, 1]
-    discharge = list(networkx.get_node_attributes(river_graph, 'flow_HR').items())
-    discharge = numpy.array(discharge)
-    discharge = discharge[:, 1]
-    total_discharge = discharge + additional_water
-
-    # update the total discharge for the changed cells
-    keys = numpy.array(list(networkx.get_node_attributes(river_graph, 'additional water').keys()))
-    discharge = {}
-    for key, value in zip(keys, total_discharge):
-        discharge[key] = value
-    networkx.set_node_attributes(river_graph, discharge, 'flow_HR')
+    additional_water = network_functions.propagate(network, additional_water)
+
+    # update the total discharge
+    total_discharge = network['flow_HR'] + additional_water
+    network_functions.network_to_graph(river_graph, network, {'additional water': additional_water,
+                                                               'flow_HR': total_discharge})
 
     return river_graph
 
@@ -182,6 +169,64 @@ def extract_river_network(river_graph: networkx.DiGraph, pixel_number: int, incl
 
     return node_network_ordered
 
+def extract_observation_network(graph_location: object, datapoint_locations, contamination_df: pandas.DataFrame,
+                                attribute_names: list = ['RT_HR', 'flow_HR'], cache_directory: str = '') -> list:
+    """
+    extract_observation_network extracts the observation nodes and everything upstream of them. These are exactly the
+    nodes that can influence the concentrations at the observations, so the model only needs to run on them when
+    calibrating.
+    :rtype: list
+    :graph_location: string or networkx.DiGraph: the river graph or its location. A location is only loaded if the
+     network is not cached, with only the attribute_names.
+    :datapoint_locations: array-like: the pixel numbers of the observations.
+    :contamination_df: pandas.DataFrame: A dataframe of contamination containing the discharge points.
+    :attribute_names: list: the attributes that are loaded when a graph location is supplied.
+    :cache_directory: str: if not empty and graph_location is a location, the upstream graph and its topological sort
+     are saved in this directory, under a name derived from the observations, the attribute names and the location
+     and modification time of the graph, and loaded from there the next time. contamination_df is filtered at every
+     call, so changes to it are always used.
+    :return: the upstream graph, a topological sort of it and the rows of contamination_df that discharge into it.
+    """
+    locations = numpy.unique(numpy.asarray(datapoint_locations, dtype=numpy.int64))
+    cache_location = ''
+    if cache_directory != '' and isinstance(graph_location, str):
+        graph_key = os.path.abspath(graph_location) + str(os.path.getmtime(graph_location))
+        key = hashlib.sha1(locations.tobytes() + str(sorted(attribute_names)).encode() + graph_key.encode()).hexdigest()
+        cache_location = os.path.join(cache_directory, 'observation_network_' + key[:16] + '.pkl')
+        if os.path.isfile(cache_location):
+            observation_graph, sorted_river_list = simple_load(cache_location)
+            contamination_df = contamination_df[contamination_df["pixel_number"].isin(observation_graph)]
+            return [observation_graph, sorted_river_list, contamination_df.reset_index(drop=True)]
+
+    if isinstance(graph_location, str):
+        river_graph = load_selected_attributes_graph(graph_location, attribute_names)
+    elif isinstance(graph_location, networkx.DiGraph):
+        river_graph = graph_location
+    else:
+        raise TypeError('Pass either a Digraph or a string. your input was ' + str(type(graph_location)))
+
+    # collect the observations and all their ancestors
+    upstream = set(locations.tolist())
+    missing = upstream.difference(river_graph)
+    if missing:
+        raise IndexError("Some observations are not in the river graph, e.g. " + str(next(iter(missing))))
+    cells_to_consider = list(upstream)
+    while len(cells_to_consider) > 0:
+        element = cells_to_consider.pop()
+        for parent in river_graph.predecessors(element):
+            if parent not in upstream:
+                upstream.add(parent)
+                cells_to_consider.append(parent)
+
+    observation_graph = river_graph.subgraph(upstream).copy()
+    sorted_river_list = list(networkx.topological_sort(observation_graph))
+    contamination_df = contamination_df[contamination_df["pixel_number"].isin(upstream)].reset_index(drop=True)
+
+    if cache_location != '':
+        simple_save([observation_graph, sorted_river_list], cache_location)
+    return [observation_graph, sorted_river_list, contamination_df]
+
+
 def describe_contamination_network(river_graph: networkx.DiGraph, ordered_node_network: list, reference_raster_location:
 str = 'reference_raster.tif', scenario: str = '', output_name:
 str = 'contaminant_network.tif') -> None:
@@ -1268,10 +1313,13 @@ def load_selected_attributes_graph(graph_location: str, attribute_names: list) -
      This functions loads a graph from a file location. The graph loaded contains only the 'attribute_names' of
       interest.
      :rtype: networkx.DiGraph
-     :graph_location: string: location of the river graph on the computer.
+     :graph_location: string: location of the river graph on the computer. This is either a pickled graph or a
+      model store directory of store_functions.graph_to_store, of which only the attributes of interest are read.
      :attribute_names: list: list of strings that are names of the attributes that need to be in the returned graph.
      :return: networkx.DiGraph: A copy of the river graph with only the attributes of interest.
      """
+    if os.path.isdir(graph_location):
+        return store_functions.store_to_graph(graph_location, attribute_names)
 
     # load the supplied graph
     open_graph = open(graph_location, "rb")
@@ -1299,10 +1347,17 @@ def save_to_main_graph(copy_graph: networkx.DiGraph, graph_location: str, attrib
      This functions takes a copy of the main graph and saves attribute fields from the copy to the main graph.
      :rtype: None
      :copy_graph: The copy of the main graph that contains some new attribute fields.
-     :graph_location: string: location of the main river graph on the computer.
+     :graph_location: string: location of the main river graph on the computer. This is either a pickled graph or a
+      model store directory of store_functions.graph_to_store, to which only the attributes are written.
      :attribute_names: list: list of strings that are names of the attributes that need to be in the main graph.
      :return: saves the new attributes into the main graph.
      """
+    if os.path.isdir(graph_location):
+        for attribute_name in attribute_names:
+            attribute = networkx.get_node_attributes(copy_graph, attribute_name)
+            store_functions.add_to_store(graph_location, {attribute_name: list(attribute.values())},
+                                         list(attribute.keys()))
+        return None
 
     # load the main graph
     open_graph = open(graph_location, "rb")
@@ -1323,7 +1378,7 @@ def save_to_main_graph(copy_graph: networkx.DiGraph, graph_location: str, attrib
     return None
 
 def run_model(river_graph: networkx.DiGraph, sorted_river_list: list, contamination_df: pandas.DataFrame,
-              parameters: list, scenario: str ='', output_field_name: str = '')\
+              parameters: list, scenario: str ='', output_field_name: str = '', pollution=None)\
         -> networkx.DiGraph:
     """
      This functions takes a graph, a contamination dataframe and parameters to calculate contamination in the river
@@ -1337,51 +1392,37 @@ def run_model(river_graph: networkx.DiGraph, sorted_river_list: list, contaminat
      :scenario: string: the scenario to be run. The default gives the hydroRIVERS scenario.
      :output_field_name: string: the output field of the graph. If this field is left empty, the output field will be
      set by default.
+     :pollution: pandas.DataFrame: optional, the pollution of every discharge point (rows) for every contaminant
+     (columns). All contaminants are run in a single pass, with the excretion and attenuation in parameters given as
+     lists with a value per contaminant. The output fields get the name of the contaminant appended.
      :return: networkx.DiGraph: the river graph with two additional fields, containing the contamination and
-                                contaminant concentration.
+                                contaminant concentration. Nodes of the graph that are not in sorted_river_list get
+                                zero in these fields. Every discharge point must be in sorted_river_list, otherwise a
+                                ValueError is raised.
      """
-    excretion, attenuation, filt_eff, primary_eff, secondary_eff, tertiary_eff = parameters
-
-    if scenario == '':
-        cont = "absolute load"
-        RT = "RT_HR"
-        dis = "flow_HR"
-        rel_cont = "concentration"
-    else:
-        cont = "absolute load " + scenario
-        RT = "RT_" + scenario
-        dis = scenario
-        rel_cont = "concentration " + scenario
-
-    if output_field_name != '':
-        cont = "Contaminant " + output_field_name
-        rel_cont = "Relative contaminant " + output_field_name
-
-    # contamination
-    treatment_efficacy = primary_eff * (contamination_df["Treatment_level"] == 1) + secondary_eff * \
-                     (contamination_df["Treatment_level"] == 2) + tertiary_eff * \
-                     (contamination_df["Treatment_level"] == 3)
-    # formula
-    contamination = (1 - treatment_efficacy) * contamination_df["Treat_a"] + (1 - filt_eff) \
-                * contamination_df["Filt_a"] + contamination_df["Unfilt_a"]
-    contamination *= contamination_df["pollution"] * excretion
-    location = contamination_df["pixel_number"]
-
-    networkx.set_node_attributes(river_graph, 0, name=cont)
-    networkx.set_node_attributes(river_graph, 0, name=rel_cont)
-
-    for i in range(len(contamination_df)):
-        pixel_number = location[i]
-        river_graph.nodes[pixel_number][cont] += contamination[i]
-
-    for n in sorted_river_list:  # for all river pixels
-            # Add the contamination of the parent cells
-        parents = list(river_graph.predecessors(n))
-        for k in parents:
-            river_graph.nodes[n][cont] += river_graph.nodes[k][cont]
-
-        river_graph.nodes[n][cont] *= math.exp(-attenuation * river_graph.nodes[n][RT])
-        river_graph.nodes[n][rel_cont] = river_graph.nodes[n][cont] / river_graph.nodes[n][dis]
+    network = network_functions.graph_to_network(river_graph, sorted_river_list,
+                                                 network_functions.scenario_fields(scenario)[1:3])
+    plant_index = network_functions.pixels_to_index(network, contamination_df["pixel_number"], missing=-1)
+    if numpy.any(plant_index < 0):
+        missing = numpy.unique(contamination_df["pixel_number"].to_numpy()[plant_index < 0])
+        raise ValueError('The discharge points of these pixels are not in sorted_river_list: ' +
+                         ', '.join(str(pixel_number) for pixel_number in missing[:10]) +
+                         (' and ' + str(len(missing) - 10) + ' more' if len(missing) > 10 else ''))
+    network_functions.run_model(network, contamination_df, parameters, scenario, river_graph, output_field_name,
+                                pollution)
+
+    # the nodes outside sorted_river_list get zero, as the output fields are initialised for all nodes
+    if len(network['pixel_number']) < river_graph.number_of_nodes():
+        cont, RT, dis, rel_cont = network_functions.scenario_fields(scenario, output_field_name)
+        if pollution is None:
+            field_names = [cont, rel_cont]
+        else:
+            names = pollution.columns if isinstance(pollution, pandas.DataFrame) else range(numpy.shape(pollution)[1])
+            field_names = [field_name + " " + str(name) for name in names for field_name in [cont, rel_cont]]
+        outside = set(river_graph).difference(network['pixel_number'].tolist())
+        for node in outside:
+            for field_name in field_names:
+                river_graph.nodes[node][field_name] = 0
 
     return river_graph
 
@@ -1,8 +1,12 @@
+import os
+import collections
 import numpy
 from scipy import sparse
+from scipy.sparse import linalg
 import networkx
 import pandas
 import pickle
+import src.library.network_functions as network_functions
 
 
 def sub_basins(river_graph: networkx.DiGraph, ordered_basin_list: list, cut_size: int) -> list:
@@ -54,6 +58,7 @@ def sub_basins(river_graph: networkx.DiGraph, ordered_basin_list: list, cut_size
 
     # collect the nodes into the mini-basins lists.
     sorted_river_list.reverse()
+    position = {node: index for index, node in enumerate(sorted_river_list)}
     mini_basins_nodes = [None] * current_basin
     for node in sorted_river_list:
 
@@ -68,7 +73,7 @@ def sub_basins(river_graph: networkx.DiGraph, ordered_basin_list: list, cut_size
         if child:
             child = child[0]
             if river_graph.nodes[node]['mini_basin'] != river_graph.nodes[child]['mini_basin']:
-                mini_basins_nodes[river_graph.nodes[node]['mini_basin']][2] = sorted_river_list.index(child)
+                mini_basins_nodes[river_graph.nodes[node]['mini_basin']][2] = position[child]
                 mini_basins_nodes[river_graph.nodes[node]['mini_basin']][1] = child
                 mini_basins_nodes[river_graph.nodes[node]['mini_basin']][0].append(child)
 
@@ -108,6 +113,7 @@ def graph_to_RT_matrix(river_graph: networkx.DiGraph, ordered_basins: list, cut_
         basin_ids = set()
         basin_nodes = basin[0]
         B = numpy.zeros((len(basin_nodes), len(basin_nodes)), dtype=numpy.float32)
+        position = {}  # the first position after j of every node, as basin_nodes.index(node, j) would give
 
         for j in reversed(range(len(basin_nodes))):  # the very last one can only have a false child!
             node = basin_nodes[j]
@@ -116,7 +122,7 @@ def graph_to_RT_matrix(river_graph: networkx.DiGraph, ordered_basins: list, cut_
 
             # this recursion determines the residence time between all the children and the parent j
             if child and j != len(basin_nodes) - 1:
-                child_index = basin_nodes.index(child[0], j)
+                child_index = position[child[0]]
                 column = B[:, child_index]
                 B[:, j] = (column > 0) * RT + column
             # 0 is reserved for no connection. If there is an RT of 0 and there is a connection (with lakes), then
@@ -124,6 +130,7 @@ def graph_to_RT_matrix(river_graph: networkx.DiGraph, ordered_basins: list, cut_
             if RT == 0:
                 RT = 0.000001
             B[j, j] = RT
+            position[node] = j
             basin_ids.add(river_graph.nodes[node]["basin"])
         df = pandas.DataFrame(basin_nodes)
         df['indicators'] = 0
@@ -138,10 +145,192 @@ def graph_to_RT_matrix(river_graph: networkx.DiGraph, ordered_basins: list, cut_
     return basin_matrices
 
 
+def graph_to_RT_matrix_sparse(river_graph: networkx.DiGraph, ordered_basins: list, cut_size: int,
+                              output_location: str = '') -> list:
+    """
+     This code creates the same matrices as graph_to_RT_matrix, but in sparse csc form, without dense intermediates.
+     Column j contains the residence times from node j to every node on its downstream path within the sub-basin, so
+     it is the column of the child of j with the residence time of j added, plus the diagonal entry of j.
+     :rtype: list
+     :river_graph: networkx.DiGraph: the river graph or the location on the computer
+     :ordered_basins: list of lists: the ordered basins of graph_functions.create_basin_lists.
+     :cut_size: int: maximum size of a sub-basin, see sub_basins.
+     :output_location: str: if not empty, the matrices are pickled to this location.
+     :return: a list with [B, child, df, basin_ids] for every sub-basin, as graph_to_RT_matrix, where B is a
+     scipy.sparse.csc_matrix.
+     """
+    mini_basins_nodes = sub_basins(river_graph, ordered_basins, cut_size)
+    basin_matrices = []
+    for basin in mini_basins_nodes:
+        basin_ids = set()
+        basin_nodes = basin[0]
+        node_count = len(basin_nodes)
+        column_rows = [None] * node_count
+        column_values = [None] * node_count
+        position = {}  # the first position after j of every node, as basin_nodes.index(node, j) would give
+
+        for j in reversed(range(node_count)):  # the very last one can only have a false child!
+            node = basin_nodes[j]
+            RT = river_graph.nodes[node]["RT_HR"]
+            child = list(river_graph.successors(node))
+            # 0 is reserved for no connection, see graph_to_RT_matrix
+            diagonal = RT if RT != 0 else 0.000001
+
+            if child and j != node_count - 1:
+                child_index = position[child[0]]
+                column_rows[j] = numpy.concatenate([[j], column_rows[child_index]])
+                column_values[j] = numpy.concatenate([[diagonal], column_values[child_index] + RT])
+            else:
+                column_rows[j] = numpy.array([j])
+                column_values[j] = numpy.array([diagonal])
+            # the values are rounded like the float32 columns of graph_to_RT_matrix
+            column_values[j] = column_values[j].astype(numpy.float32).astype(numpy.float64)
+            position[node] = j
+            basin_ids.add(river_graph.nodes[node]["basin"])
+
+        column_pointer = numpy.zeros(node_count + 1, dtype=numpy.int64)
+        column_pointer[1:] = numpy.cumsum([len(rows) for rows in column_rows])
+        B = sparse.csc_matrix((numpy.concatenate(column_values).astype(numpy.float32), numpy.concatenate(column_rows),
+                               column_pointer), shape=(node_count, node_count))
+        column_rows = column_values = None
+
+        df = pandas.DataFrame(basin_nodes)
+        df['indicators'] = 0
+        df = df.set_index(0)
+
+        basin_matrices.append([B, basin[1], df, basin_ids])
+    if output_location != '':
+        open_ts = open(output_location, "wb")
+        pickle.dump(basin_matrices, open_ts)
+        open_ts.close()
+
+    return basin_matrices
+
+
+def save_basin_matrices(basin_matrices: list, directory: str, compressed: bool = True) -> None:
+    """
+     Saves the basin matrices of graph_to_RT_matrix(_sparse) with a file for every sub-basin matrix and an index that
+     links the basin ids to the files, such that load_basin_matrices only reads the requested basins.
+     :rtype: None
+     :basin_matrices: list: the basin matrices [B, child, df, basin_ids].
+     :directory: str: the directory of the matrices. It is created if it does not exist. Earlier matrices in it are
+     replaced.
+     :compressed: bool: if True, every matrix is a compressed .npz file. If False, every matrix is a directory of .npy
+     files, which can be memory mapped by load_basin_matrices.
+     :return: None
+     """
+    os.makedirs(directory, exist_ok=True)
+    for file_name in os.listdir(directory):
+        if file_name.startswith('matrix_'):
+            location = os.path.join(directory, file_name)
+            if os.path.isdir(location):
+                for array_name in os.listdir(location):
+                    os.remove(os.path.join(location, array_name))
+                os.rmdir(location)
+            else:
+                os.remove(location)
+
+    child = []
+    basin_pointer = [0]
+    basin_id = []
+    for j, (B, basin_child, df, basin_ids) in enumerate(basin_matrices):
+        B = sparse.csc_matrix(B)
+        arrays = {'data': B.data, 'indices': B.indices, 'indptr': B.indptr, 'shape': numpy.array(B.shape),
+                  'nodes': numpy.asarray(df.index, dtype=numpy.int64)}
+        if compressed:
+            numpy.savez_compressed(os.path.join(directory, basin_matrix_name(j) + '.npz'), **arrays)
+        else:
+            location = os.path.join(directory, basin_matrix_name(j))
+            os.makedirs(location)
+            for array_name, values in arrays.items():
+                numpy.save(os.path.join(location, array_name + '.npy'), values)
+        child.append(-1 if basin_child is None else basin_child)
+        basin_id += sorted(basin_ids)
+        basin_pointer.append(len(basin_id))
+
+    numpy.savez(os.path.join(directory, 'index.npz'), child=numpy.array(child, dtype=numpy.int64),
+                basin_pointer=numpy.array(basin_pointer, dtype=numpy.int64),
+                basin_id=numpy.array(basin_id, dtype=numpy.int64), compressed=numpy.array(compressed))
+
+
+def load_basin_matrices(directory: str, basin_ids_picked: list = None, mmap_mode: str = None) -> list:
+    """
+     Loads the basin matrices of save_basin_matrices. Only the files of matrices that contain a picked basin are read.
+     :rtype: list
+     :directory: str: the directory of save_basin_matrices.
+     :basin_ids_picked: list: the ids of the basins to load. If None, all matrices are loaded.
+     :mmap_mode: str: the mmap_mode of numpy.load, only used for matrices saved with compressed=False.
+     :return: a list with [B, child, df, basin_ids] for every matrix with a picked basin, in the saved order, where B
+     is a scipy.sparse.csc_matrix.
+     """
+    with numpy.load(os.path.join(directory, 'index.npz')) as index:
+        child = index['child']
+        basin_pointer = index['basin_pointer']
+        basin_id = index['basin_id']
+
+    if basin_ids_picked is None:
+        matrices_picked = numpy.arange(len(child))
+    else:
+        picked = numpy.isin(basin_id, numpy.asarray(list(basin_ids_picked), dtype=numpy.int64))
+        matrices_picked = numpy.unique(numpy.searchsorted(basin_pointer, numpy.flatnonzero(picked), side='right') - 1)
+
+    basin_matrices = []
+    for j in matrices_picked:
+        location = os.path.join(directory, basin_matrix_name(j))
+        if os.path.isdir(location):
+            arrays = {array_name: numpy.load(os.path.join(location, array_name + '.npy'), mmap_mode=mmap_mode)
+                      for array_name in ['data', 'indices', 'indptr', 'shape', 'nodes']}
+        else:
+            with numpy.load(location + '.npz') as data:
+                arrays = {array_name: data[array_name] for array_name in data.files}
+        B = sparse.csc_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=tuple(arrays['shape']))
+        df = pandas.DataFrame({'indicators': 0}, index=pandas.Index(numpy.asarray(arrays['nodes']).tolist(), name=0))
+        basin_child = None if child[j] == -1 else int(child[j])
+        basin_ids = set(basin_id[basin_pointer[j]:basin_pointer[j + 1]].tolist())
+        basin_matrices.append([B, basin_child, df, basin_ids])
+
+    return basin_matrices
+
+
+def basin_matrix_name(j: int) -> str:
+    """
+     Gives the file name of a basin matrix of save_basin_matrices, without extension.
+     :rtype: str
+     :j: int: the number of the matrix.
+     :return: the file name.
+     """
+    return 'matrix_' + str(j).zfill(5)
+
+
+def dense_basin_matrices(basin_matrices: list) -> list:
+    """
+     Converts the sparse basin matrices of graph_to_RT_matrix_sparse to the dense matrices of graph_to_RT_matrix, for
+     the dense functions matrix_subset, create_attenuation_matrices, run_basin_matrices and get_plant_column.
+     :rtype: list
+     :basin_matrices: list: the basin matrices [B, child, df, basin_ids]. Dense matrices are kept as they are.
+     :return: a list with [B, child, df, basin_ids] for every matrix, where B is a float32 numpy array.
+     """
+    return [[B.toarray().astype(numpy.float32) if sparse.issparse(B) else B, child, df, basin_ids]
+            for B, child, df, basin_ids in basin_matrices]
+
+
+def check_dense(basin_matrices: list, sparse_function: str) -> None:
+    """
+     Raises a TypeError if the basin matrices are sparse, since the dense functions cannot use them.
+     :rtype: None
+     :basin_matrices: list: the basin matrices [B, child, df, basin_ids].
+     :sparse_function: str: the name of the function for sparse matrices.
+     :return: None
+     """
+    if any(sparse.issparse(basin_matrices[j][0]) for j in range(len(basin_matrices))):
+        raise TypeError('The basin matrices are sparse, as written by graph_to_RT_matrix_sparse. Use ' +
+                        sparse_function + ', or convert them with dense_basin_matrices')
+
+
 def matrix_subset(matrices_source, basin_ids_picked, basin_nodes, basin_ids_locations, cut_size):
-    # open the matrices
+    # open the matrices. basin_matrices.pkl of "8.3 basin_matrices.py" holds sparse matrices, which are made dense.
     open_ts = open(matrices_source, "rb")
-    basin_matrices = pickle.load(open_ts)
+    basin_matrices = dense_basin_matrices(pickle.load(open_ts))
     open_ts.close()
 
     # step 1; clean space
@@ -272,15 +461,15 @@ def matrix_subset(matrices_source, basin_ids_picked, basin_nodes, basin_ids_loca
 
 
 def create_attenuation_matrices(basin_matrices, attenuation):
-    for i in range(len(basin_matrices)):
-        rows, columns = numpy.shape(basin_matrices[i][0])
-        for j in range(rows):
-           current_row = basin_matrices[i][0][j,:]
-           basin_matrices[i][0][j,:] = (current_row > 0) * numpy.exp(-attenuation * current_row)
-    return basin_matrices
+    check_dense(basin_matrices, 'create_attenuation_matrices_sparse')
+    attenuation_matrices = []
+    for B, child, df, basin_ids in basin_matrices:
+        attenuation_matrices.append([(B > 0) * numpy.exp(-attenuation * B), child, df, basin_ids])
+    return attenuation_matrices
 
 
 def run_basin_matrices(basin_matrices, pixel_order, initial_contamination):
+    check_dense(basin_matrices, 'run_basin_matrices_sparse')
     final_contamination = numpy.zeros([len(initial_contamination)])
     indicators = numpy.zeros([len(initial_contamination)], bool)
     row_count = 0
@@ -307,196 +496,244 @@ def run_basin_matrices(basin_matrices, pixel_order, initial_contamination):
 
 def matrix_subset_sparse(matrices_source, basin_ids_picked, basin_nodes, basin_ids_locations, cut_size, opt='rows',
                          cut_minimum=0):
+    """
+     This code selects the sub-basin matrices of graph_to_RT_matrix(_sparse) that belong to some basins, and merges
+     small sub-basin matrices into the matrix that contains their child. Nodes are found through dictionaries that map
+     them to their matrix and position, matrices are merged with sparse.bmat and the dataframe of the pixel order is
+     built once at the end.
+     :rtype: list
+     :matrices_source: str or list: the location of the pickled basin matrices, the directory of save_basin_matrices
+     or the basin matrices themselves.
+     :basin_ids_picked: list: the ids of the basins to keep.
+     :basin_nodes: list: the ordered basins of graph_functions.create_basin_lists.
+     :basin_ids_locations: list: the basin id of every list in basin_nodes.
+     :cut_size: int: a merged matrix must have fewer rows than cut_size.
+     :opt: str: 'rows' gives csr matrices, 'columns' gives csc matrices.
+     :cut_minimum: int: only matrices with at most cut_minimum rows are merged into the matrix of their child.
+     :return: the basin matrices [B, child, df, basin_ids] in the order to run them, and a dataframe with the pixels in
+     the order of the rows of the matrices (without the shared child rows).
+     """
     # open the matrices
-    if isinstance(matrices_source, str):
+    if isinstance(matrices_source, str) and os.path.isdir(matrices_source):
+        basin_matrices = load_basin_matrices(matrices_source, basin_ids_picked)
+    elif isinstance(matrices_source, str):
         open_ts = open(matrices_source, "rb")
         basin_matrices = pickle.load(open_ts)
         open_ts.close()
     else:
         basin_matrices = matrices_source
 
-    # step 1; clean space
-    for j in reversed(range(len(basin_matrices))):
-        lets_delete = True
-        for basin_id in basin_matrices[j][3]:
-            if basin_id in basin_ids_picked:
-                lets_delete = False
-                break
-        if lets_delete:
-            del basin_matrices[j]
-
-    # step 2, reduce matrices that are only partly necessary
-    for j in range(len(basin_matrices)):
-        delete_some = False
-        for basin_id in basin_matrices[j][3]:
-            if basin_id not in basin_ids_picked:
-                delete_some = True
-                break
-        if delete_some:
-            nodes_to_keep = []
-            for basin_id in basin_matrices[j][3]:
-                if basin_id in basin_ids_picked:
-                    basin_id_index = basin_ids_locations.index(basin_id)
-                    nodes_to_keep += basin_nodes[basin_id_index]
-            try:
-                basin_matrices[j][2]['indicators'].loc[nodes_to_keep] = 1
-                indices = numpy.array(basin_matrices[j][2]['indicators'], bool)
-                basin_matrices[j][0] = basin_matrices[j][0][indices, :]
-                basin_matrices[j][0] = basin_matrices[j][0][:, indices]
-                basin_matrices[j][2] = basin_matrices[j][2][indices == 1]
-                basin_matrices[j][2]['indicators'] = 0
-
-            except KeyError:  # should occur if the entire matrix must be kept
-                pass
+    basin_ids_picked = set(basin_ids_picked)
+    basin_index = None  # the position of every basin id in basin_ids_locations, created when needed
 
-    # step 3, connect small matrices within same basin
-
-    # collect the pixels that the matrices refer to
-    final_row = [0]  # this is a list of the final row number of the matrices (actually starting)
-    df = basin_matrices[0][2]  # this contains all the pixels in order of the matrices
-
-    for j in range(len(basin_matrices)):
-        if basin_matrices[j][1] is not None:
-            basin_matrices[j][2].drop(basin_matrices[j][1], axis=0, inplace=True)
-        final_row.append(final_row[len(final_row) - 1] + len(basin_matrices[j][2]))
-        if j > 0:
-            df = pandas.concat([df, basin_matrices[j][2]], axis=0)
-
-    nodes_df = df.reset_index()
-    node_list = list(nodes_df[0])  # now we have the pixels in the order of the matrices
-
-    #  We continue to try to merge matrices that are in the same basin
+    # step 1 and 2; keep the matrices of the picked basins, and only the nodes of the picked basins in those matrices.
+    # Basins are not connected to each other, so removing the nodes of other basins does not change the results.
+    blocks = []  # [matrix, child, nodes, basin_ids]. The child is the last of the nodes if it is not None.
+    for matrix, child, df, basin_ids in basin_matrices:
+        if not basin_ids_picked.intersection(basin_ids):
+            continue
+        matrix = sparse.csc_matrix(matrix)
+        nodes = list(df.index)
+        if not basin_ids_picked.issuperset(basin_ids):
+            if basin_index is None:
+                basin_index = {basin_id: index for index, basin_id in enumerate(basin_ids_locations)}
+            nodes_to_keep = set()
+            for basin_id in basin_ids_picked.intersection(basin_ids):
+                nodes_to_keep.update(basin_nodes[basin_index[basin_id]])
+            keep = numpy.fromiter((node in nodes_to_keep for node in nodes), dtype=bool, count=len(nodes))
+            matrix = matrix[keep][:, keep]
+            nodes = [node for node, kept in zip(nodes, keep) if kept]
+        blocks.append([matrix, child, nodes, set(basin_ids)])
+    basin_matrices = None
+
+    # step 3; merge small matrices into the matrix that contains their child.
+    block_of_node = {}  # the block of every node, except for the shared child rows
+    for index, (matrix, child, nodes, basin_ids) in enumerate(blocks):
+        for node in (nodes if child is None else nodes[:-1]):
+            block_of_node[node] = index
+    positions = {}  # the positions of the nodes within a block, created when needed
     merge_found = True
     while merge_found:
         merge_found = False
-        j = 0
-        while j < len(basin_matrices):  # while statement since basin_matrices may decrease in length.
-            if isinstance(basin_matrices[j][0], numpy.ndarray):
-                if len(basin_matrices[j][0]) > cut_minimum:
-                    if opt=='rows':
-                        basin_matrices[j][0] =  sparse.csr_matrix(basin_matrices[j][0])
-                    elif opt=='columns':
-                        basin_matrices[j][0] =  sparse.csc_matrix(basin_matrices[j][0])
-                    j += 1
-                    continue
+        for j in range(len(blocks)):
+            if blocks[j] is None or blocks[j][1] is None:
+                continue
+            current_matrix, child, current_nodes, current_ids = blocks[j]
+            size_current = current_matrix.shape[0] - 1
+            index = block_of_node.get(child)
+            if current_matrix.shape[0] > cut_minimum or index is None or index == j:
+                continue
+            next_matrix, next_child, next_nodes, next_ids = blocks[index]
+            if size_current + next_matrix.shape[0] >= cut_size:
+                continue
+            if index not in positions:
+                positions[index] = {node: position for position, node in enumerate(next_nodes)}
+            child_index_next_matrix = positions[index][child]
+
+            # the last row of the current matrix forms the link: the residence time from every node to the child,
+            # without the residence time of the child. Every node downstream of the child gets that added.
+            last_row = current_matrix[size_current, :size_current].tocoo()
+            last_row_current = last_row.data - current_matrix[size_current, size_current]
+            child_column = next_matrix[:, child_index_next_matrix].tocoo()
+            link = sparse.coo_matrix(((last_row_current[None, :] + child_column.data[:, None]).ravel(),
+                                      (numpy.repeat(child_column.row, len(last_row.col)),
+                                       numpy.tile(last_row.col, len(child_column.row)))),
+                                     shape=(next_matrix.shape[0], size_current))
+            new_matrix = sparse.bmat([[current_matrix[:size_current, :size_current], None], [link, next_matrix]],
+                                     format='csc')
+
+            blocks[index] = [new_matrix, next_child, current_nodes[:size_current] + next_nodes,
+                             current_ids.union(next_ids)]
+            blocks[j] = None
+            positions.pop(index, None)
+            for node in current_nodes[:size_current]:
+                block_of_node[node] = index
+            merge_found = True
+
+    # build the output, with the dataframes of the pixel order
+    basin_matrices = []
+    for matrix, child, nodes, basin_ids in [block for block in blocks if block is not None]:
+        if opt == 'rows':
+            matrix = sparse.csr_matrix(matrix)
+        elif opt == 'columns':
+            matrix = sparse.csc_matrix(matrix)
+        df = pandas.DataFrame({'indicators': 0}, index=pandas.Index(nodes if child is None else nodes[:-1], name=0))
+        basin_matrices.append([matrix, child, df, basin_ids])
+    df = pandas.DataFrame({'indicators': 0}, index=pandas.Index(
+        [node for matrix, child, block_df, basin_ids in basin_matrices for node in block_df.index], name=0))
 
-            if basin_matrices[j][1] is not None:  # only consider a merge if the basin is a sub-basin
-                child_index = node_list.index(basin_matrices[j][1])
-                # find the matrix that contains this child_index
-                for i in range(len(final_row)):
-                    if child_index > final_row[i]:
-                        index = i
-                current_matrix = basin_matrices[j][0]
-                next_matrix = basin_matrices[index][0]
-                if not isinstance(next_matrix, numpy.ndarray) or not isinstance(current_matrix, numpy.ndarray):
-                    j += 1
-                    continue
-                size_current = len(current_matrix) - 1
-                size_next = len(next_matrix)
-                if size_current + size_next < cut_size:  # merge the matrices if the cut_size is acceptable
-                    merge_found = True
-                    # last_row current forms the link between the two matrices.
-                    last_row_current = current_matrix[size_current][0:size_current] - \
-                                       current_matrix[size_current][size_current]
-                    # delete last row and column from the current matrix
-                    current_matrix = current_matrix[:, 0:size_current]
-                    current_matrix = current_matrix[0:size_current][:]
+    return basin_matrices, df
 
-                    # now create the new matrix that links the sub-basins
-                    last_row_indicator = last_row_current > 0
-                    C = numpy.zeros([size_next, size_current])
-                    D = numpy.zeros([size_current, size_next])
-                    child_index_next_matrix = child_index - final_row[index]
-                    for row_number in range(size_next):
-                        C[row_number][:] = last_row_current * (next_matrix[row_number][child_index_next_matrix] > 0) \
-                                           + next_matrix[row_number][child_index_next_matrix]
-                    new_matrix = numpy.asarray(numpy.bmat([[current_matrix, D], [C, next_matrix]]))
-                    basin_matrices[index][0] = new_matrix
-                    basin_matrices[index][2] = pandas.concat([basin_matrices[j][2], basin_matrices[index][2]], axis=0)
-                    new_node_list = node_list[0:final_row[j]]
-                    new_node_list += node_list[final_row[j + 1]:final_row[index]]
-                    new_nodes = basin_matrices[index][
-                        2].reset_index()  # the index is one to the left due to delete of j
-                    new_node_list += list(new_nodes[0])
-                    new_node_list += node_list[final_row[index + 1]:len(node_list)]
-                    node_list = new_node_list
-                    del basin_matrices[j]
-                    del final_row[j]
-                    final_row[j:index] = [final_row[n] - size_current for n in range(j, index)]
 
-                else:
-                    j += 1
-            else:
-                j += 1
+def create_attenuation_matrices_sparse(basin_matrices, attenuation):
+    """
+     Creates the attenuation matrices of the residence time matrices, exp(-attenuation * RT) for every stored entry.
+     The residence time matrices are not changed; the attenuation matrices share their sparsity structure.
+     :rtype: list
+     :basin_matrices: list: the residence time matrices [B, child, df, basin_ids], e.g. of matrix_subset_sparse.
+     :attenuation: float: the attenuation constant.
+     :return: a list with [A, child, df, basin_ids] for every matrix.
+     """
+    attenuation_matrices = []
+    for B, child, df, basin_ids in basin_matrices:
+        A = type(B)((numpy.exp(-attenuation * B.data), B.indices, B.indptr), shape=B.shape)
+        A.indices, A.indptr = B.indices, B.indptr  # the constructor may copy the structure
+        attenuation_matrices.append([A, child, df, basin_ids])
 
-    # step 4; rejoin some very small matrices.
-    while j < len(basin_matrices) - 1:
-        current_mini_basin_len = len(basin_matrices[j][0])
-        next_mini_basin_len = len(basin_matrices[j+1][0])
-        if basin_matrices[j][1] is None:
-            if current_mini_basin_len + next_mini_basin_len < cut_size:
-                Y = numpy.zeros([current_mini_basin_len, next_mini_basin_len])
-                Z = numpy.zeros([next_mini_basin_len, current_mini_basin_len])
-                basin_matrices[j+1][0] = numpy.asarray(
-                    numpy.bmat([[basin_matrices[j][0], Y], [Z, basin_matrices[j+1][0]]]))
-                basin_matrices[j+1][2] = pandas.concat([basin_matrices[j][2], basin_matrices[j+1][2]], axis=0)
-                del basin_matrices[j]
-                j -= 1
-        j +=1
+    return attenuation_matrices
 
 
-    df = basin_matrices[0][2]  # this contains all the pixels in order of the matrices
+class AttenuationCache:
+    """
+     Keeps the attenuation matrices of create_attenuation_matrices_sparse for the most recently used attenuations,
+     such that a sweep or a calibration over the attenuation uses the residence time matrices loaded once. The least
+     recently used attenuation is dropped when the cached matrices take more than the memory budget, but the last
+     requested attenuation is always kept.
+     :basin_matrices: list: the residence time matrices [B, child, df, basin_ids], e.g. of matrix_subset_sparse.
+     :memory_budget: int: the maximum amount of bytes of cached matrix values.
+     """
+    def __init__(self, basin_matrices: list, memory_budget: int = 2 ** 30):
+        self.basin_matrices = basin_matrices
+        self.memory_budget = memory_budget
+        self.matrices = collections.OrderedDict()
+        self.memory = 0
 
-    for j in range(1, len(basin_matrices)):
-        df = pandas.concat([df, basin_matrices[j][2]], axis=0)
+    def __getitem__(self, attenuation: float) -> list:
+        attenuation = float(attenuation)
+        if attenuation in self.matrices:
+            self.matrices.move_to_end(attenuation)
+            return self.matrices[attenuation]
 
-    # make the matrices sparse:
-    if opt == 'rows':
-        for j in range(len(basin_matrices)):
-            if isinstance(basin_matrices[j][0], numpy.ndarray):
-                basin_matrices[j][0] = sparse.csr_matrix(basin_matrices[j][0])
-    elif opt == 'columns':
-        for j in range(len(basin_matrices)):
-            if isinstance(basin_matrices[j][0], numpy.ndarray):
-               basin_matrices[j][0] = sparse.csc_matrix(basin_matrices[j][0])
+        attenuation_matrices = create_attenuation_matrices_sparse(self.basin_matrices, attenuation)
+        self.matrices[attenuation] = attenuation_matrices
+        self.memory += matrices_memory(attenuation_matrices)
+        while self.memory > self.memory_budget and len(self.matrices) > 1:
+            dropped_attenuation, dropped_matrices = self.matrices.popitem(last=False)
+            self.memory -= matrices_memory(dropped_matrices)
 
-    return basin_matrices, df
+        return attenuation_matrices
 
+    def __contains__(self, attenuation: float) -> bool:
+        return float(attenuation) in self.matrices
 
-def create_attenuation_matrices_sparse(basin_matrices, attenuation):
-    for i in range(len(basin_matrices)):
-        basin_matrices[i][0].data = numpy.exp(-attenuation * basin_matrices[i][0].data)
+    def __len__(self) -> int:
+        return len(self.matrices)
 
-    return basin_matrices
+    def clear(self) -> None:
+        self.matrices.clear()
+        self.memory = 0
 
 
-def run_basin_matrices_sparse(basin_matrices, pixel_order, init_cont):
-    initial_contamination = init_cont.copy()
-    final_contamination = numpy.zeros([len(initial_contamination)])
-    indicators = numpy.zeros([len(initial_contamination)], bool)
-    row_count = 0
+def matrices_memory(basin_matrices: list) -> int:
+    """
+     Gives the bytes of the values of the basin matrices, which is what create_attenuation_matrices_sparse copies.
+     :rtype: int
+     :basin_matrices: list: the basin matrices [B, child, df, basin_ids].
+     :return: the amount of bytes.
+     """
+    return sum(basin_matrices[j][0].data.nbytes for j in range(len(basin_matrices)))
 
+
+def basin_matrix_positions(basin_matrices, pixel_order) -> list:
+    """
+     Finds the rows of the pixel order that every basin matrix works on, such that run_basin_matrices_sparse does not
+     have to search for the children in every run.
+     :rtype: list
+     :basin_matrices: list: the basin matrices of matrix_subset_sparse.
+     :pixel_order: list: the pixels in the order of the rows of the matrices.
+     :return: a list with [rows, child_index] for every matrix, where rows gives the positions in the pixel order of the
+     rows of the matrix (a slice if there is no child) and child_index the position of the child, or None.
+     """
+    position = {}
+    for index in reversed(range(len(pixel_order))):
+        position[pixel_order[index]] = index
+
+    positions = []
+    row_count = 0
     for j in range(len(basin_matrices)):
-        rows, columns = numpy.shape(basin_matrices[j][0])
+        rows = numpy.shape(basin_matrices[j][0])[0]
         last_row_count = row_count
         row_count += rows
         if basin_matrices[j][1] is None:
-            final_contamination[last_row_count:row_count] = \
-                basin_matrices[j][0] @ initial_contamination[last_row_count:row_count]
+            positions.append([slice(last_row_count, row_count), None])
         else:
             row_count -= 1
-            child_index = pixel_order.index(basin_matrices[j][1], row_count)
-            indicators[last_row_count:row_count] = True
-            indicators[child_index] = True
-            final_contamination[indicators] = basin_matrices[j][0] @ initial_contamination[indicators]
-            indicators = numpy.zeros([len(initial_contamination)], bool)
+            child_index = position.get(basin_matrices[j][1], -1)
+            if child_index < row_count:  # the child is found after the rows of the matrix, as pixel_order.index does
+                child_index = pixel_order.index(basin_matrices[j][1], row_count)
+            positions.append([numpy.append(numpy.arange(last_row_count, row_count), child_index), child_index])
+
+    return positions
+
+
+def run_basin_matrices_sparse(basin_matrices, pixel_order, init_cont, positions=None):
+    """
+     Runs the basin matrices. Every matrix is applied to the initial loads of its rows, and the load that a matrix
+     brings to the child is added to the initial load of the child for the matrix that contains the child.
+     :rtype: numpy.ndarray
+     :basin_matrices: list: the attenuation matrices of create_attenuation_matrices_sparse.
+     :pixel_order: list: the pixels in the order of the rows of the matrices.
+     :init_cont: numpy.ndarray: the initial load of every pixel, or a (pixels x k) array with k sets of initial loads,
+     e.g. scenarios, contaminants or Monte Carlo samples.
+     :positions: list: the result of basin_matrix_positions, which is computed if it is not given.
+     :return: the load of every pixel, with the shape of init_cont.
+     """
+    if positions is None:
+        positions = basin_matrix_positions(basin_matrices, pixel_order)
+    initial_contamination = numpy.array(init_cont, dtype=float)
+    final_contamination = numpy.zeros(initial_contamination.shape)
+
+    for j in range(len(basin_matrices)):
+        rows, child_index = positions[j]
+        final_contamination[rows] = basin_matrices[j][0] @ initial_contamination[rows]
+        if child_index is not None:
+            last_row = len(rows) - 1
             initial_contamination[child_index] = final_contamination[child_index] / basin_matrices[j][0][
-               rows - 1, rows - 1]
+                last_row, last_row]
 
     return final_contamination
 
 
-
 def get_plant_column_sparse(basin_matrices, pixel_order, plant_pixel_number):
 
     plant_column = numpy.zeros([len(pixel_order)])
@@ -755,6 +992,7 @@ def simple_reduce(matrices_source, basin_ids_picked, basin_nodes, basin_ids_loca
 
 
 def get_plant_column(basin_matrices, pixel_order, plant_pixel_number):
+    check_dense(basin_matrices, 'get_plant_column_sparse')
 
     plant_column = numpy.zeros([len(pixel_order)])
     indicators = numpy.zeros([len(pixel_order)], bool)
@@ -806,3 +1044,127 @@ def add_initial_contaminant_to_df(cont_df, pixels_df, all_df, parameters):
     pixels_df['indicators'][cont_df['pixel_number']] = cont_df['init_cont']
     pixels_df.columns = ['initial_contaminant', 'weight', 'id_Country']
     return pixels_df
+
+
+def network_to_system(network: dict, attenuation: float, scenario: str = '') -> list:
+    """
+     This code writes the model as one sparse linear system. With x the initial load, D the decay of every node and A
+     the adjacency with A[child, parent] = 1, the load satisfies load = D (x + A load), i.e. (I - D A) load = D x.
+     Parents have a smaller index than their children in a network, so I - D A is lower triangular with a unit
+     diagonal. Unlike graph_to_RT_matrix, the system has one entry per node and per edge, so whole basins (or all of
+     Europe) fit without splitting them into sub-basins.
+     :rtype: list
+     :network: dict: the network created by network_functions.graph_to_network. It must contain the residence time
+     field of the scenario.
+     :attenuation: float: the attenuation.
+     :scenario: string: the scenario whose residence times are used. The default gives the hydroRIVERS scenario.
+     :return: the system matrix I - D A in csr form and the decay D of every node.
+     """
+    cont, RT, dis, rel_cont = network_functions.scenario_fields(scenario)
+    decay = numpy.exp(-attenuation * numpy.asarray(network[RT], dtype=numpy.float64))
+    node_count = len(decay)
+    parents = numpy.flatnonzero(network['child'] >= 0)
+    children = network['child'][parents]
+    system_matrix = sparse.csr_matrix((numpy.concatenate([numpy.ones(node_count), -decay[children]]),
+                                       (numpy.concatenate([numpy.arange(node_count), children]),
+                                        numpy.concatenate([numpy.arange(node_count), parents]))),
+                                      shape=(node_count, node_count))
+    return [system_matrix, decay]
+
+
+def solve_system(system: list, initial_load: numpy.ndarray) -> numpy.ndarray:
+    """
+     Solves the system of network_to_system with a sparse triangular solve.
+     :rtype: numpy.ndarray
+     :system: list: the system matrix and the decay given by network_to_system.
+     :initial_load: numpy.ndarray: the initial load of every node. It may have a column for every run (scenarios,
+     contaminants, samples), which are all solved at once.
+     :return: the load of every node, with the same shape as initial_load.
+     """
+    system_matrix, decay = system
+    initial_load = numpy.asarray(initial_load, dtype=numpy.float64)
+    right_hand_side = initial_load * decay.reshape((-1,) + (1,) * (initial_load.ndim - 1))
+    return linalg.spsolve_triangular(system_matrix, right_hand_side, lower=True, unit_diagonal=True)
+
+
+def run_system(network: dict, contamination_df: pandas.DataFrame, parameters: list, scenario: str = '') -> list:
+    """
+     This functions runs the model as a sparse triangular system, see network_to_system. It gives the same results as
+     network_functions.run_model up to rounding.
+     :rtype: list
+     :network: dict: the network created by network_functions.graph_to_network. It must contain the residence time and
+     discharge fields of the scenario.
+     :contamination_df: pandas.DataFrame: A dataframe of contamination containing the discharge points.
+     :parameters: list: A list of the parameters in the model, including excretion, attenuation, filtered efficacy,
+                        primary efficacy, secondary efficacy and tertiary efficacy.
+     :scenario: string: the scenario to be run. The default gives the hydroRIVERS scenario.
+     :return: the load and the concentration of every node, in the order of network['pixel_number'].
+     """
+    cont, RT, dis, rel_cont = network_functions.scenario_fields(scenario)
+    init_load = network_functions.initial_loads(network, contamination_df,
+                                                network_functions.plant_loads(contamination_df, parameters))
+    load = solve_system(network_to_system(network, parameters[1], scenario), init_load)
+    return [load, load / network[dis]]
+
+
+def influence_matrix(network: dict, contamination_df: pandas.DataFrame, attenuation: float, scenario: str = '',
+                     threshold: float = 0.0, output_location: str = '') -> sparse.csc_matrix:
+    """
+     This code creates the influence matrix of the treatment plants on the river nodes. Entry [n, p] is the fraction
+     of the load of plant p that arrives at node n, i.e. the product of the decay of all nodes from the plant down to
+     n. The load of every node is then the influence matrix times the loads of network_functions.plant_loads, and the
+     plants that affect a node are the nonzero entries of its row. All plants walk downstream together, so the amount
+     of python iterations equals the length of the longest path.
+     :rtype: scipy.sparse.csc_matrix
+     :network: dict: the network created by network_functions.graph_to_network. It must contain the residence time
+     field of the scenario.
+     :contamination_df: pandas.DataFrame: A dataframe of contamination containing the discharge points, e.g.
+     AGG_WWTP_df.csv.
+     :attenuation: float: the attenuation.
+     :scenario: string: the scenario whose residence times are used. The default gives the hydroRIVERS scenario.
+     :threshold: float: fractions below the threshold are left out, as well as the rest of the path of that plant.
+     :output_location: str: if not empty, the matrix is saved to this location with scipy.sparse.save_npz.
+     :return: the influence matrix in csc form, with a row for every node in the order of network['pixel_number'] and
+     a column for every row of contamination_df.
+     """
+    cont, RT, dis, rel_cont = network_functions.scenario_fields(scenario)
+    decay = numpy.exp(-attenuation * numpy.asarray(network[RT], dtype=numpy.float64))
+    child = network['child']
+
+    node = network_functions.table_to_index(network, contamination_df)
+    plant = numpy.arange(len(node))
+    fraction = decay[node]
+    rows, columns, values = [], [], []
+    while len(node) > 0:
+        keep = fraction >= threshold
+        node, plant, fraction = node[keep], plant[keep], fraction[keep]
+        rows.append(node)
+        columns.append(plant)
+        values.append(fraction)
+        node = child[node]
+        keep = node >= 0
+        node, plant = node[keep], plant[keep]
+        fraction = fraction[keep] * decay[node]
+
+    influence = sparse.csc_matrix((numpy.concatenate(values), (numpy.concatenate(rows), numpy.concatenate(columns))),
+                                  shape=(len(child), len(contamination_df)))
+    if output_location != '':
+        sparse.save_npz(output_location, influence)
+
+    return influence
+
+
+def load_influence_matrix(location: str, opt: str = 'columns') -> sparse.spmatrix:
+    """
+     Loads an influence matrix saved by influence_matrix.
+     :rtype: scipy.sparse.spmatrix
+     :location: str: the location of the matrix.
+     :opt: str: 'columns' gives the saved csc matrix, for the influence of single plants. 'rows' gives a csr matrix,
+     for the plants that affect single nodes.
+     :return: the influence matrix.
+     """
+    influence = sparse.csc_matrix(sparse.load_npz(location))
+    if opt == 'rows':
+        return sparse.csr_matrix(influence)
+    return influence
+
@@ -0,0 +1,988 @@
+import os
+import sys
+import heapq
+import numpy
+import networkx
+import pandas
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+
+
+def graph_to_network(river_graph: networkx.DiGraph, sorted_river_list: list = None,
+                     attribute_names: list = ['RT_HR', 'flow_HR']) -> dict:
+    """
+     This code takes a river graph and converts it to a network of contiguous arrays. The nodes are grouped by their
+     depth from the headwaters: headwaters have level 0 and every other node has a level one higher than its deepest
+     parent. Nodes are indexed level by level, such that the nodes of level l are
+     level_pointer[l]:level_pointer[l + 1], and parents always have a smaller index than their children. The parents of
+     a node are stored in compressed sparse row form: the parents of node i are
+     parent_index[parent_pointer[i]:parent_pointer[i + 1]].
+     :rtype: dict
+     :river_graph: networkx.DiGraph: the river graph. Every node may have at most one child.
+     :sorted_river_list: list: the nodes to include, preferably in topological order. Defaults to all nodes.
+     :attribute_names: list: the node attributes that are copied to float arrays, e.g. 'RT_HR' and 'flow_HR'.
+     :return: a dictionary with the arrays 'pixel_number', 'child' (-1 if the node has no child), 'parent_pointer',
+     'parent_index', 'level_pointer', the pixel index of add_pixel_index and one array for each of the attribute_names.
+     """
+    if sorted_river_list is None:
+        sorted_river_list = list(networkx.topological_sort(river_graph))
+    pixel_number = numpy.asarray(sorted_river_list, dtype=numpy.int64)
+    node_count = len(pixel_number)
+
+    # translate the edges to indices in sorted_river_list
+    edges = numpy.array([edge for edge in river_graph.edges], dtype=numpy.int64).reshape(-1, 2)
+    lookup = add_pixel_index({'pixel_number': pixel_number})
+    source = pixels_to_index(lookup, edges[:, 0], missing=-1)
+    target = pixels_to_index(lookup, edges[:, 1], missing=-1)
+    inside = (source >= 0) & (target >= 0)  # only keep edges between nodes in sorted_river_list
+    source = source[inside]
+    target = target[inside]
+
+    if numpy.any(numpy.bincount(source, minlength=node_count) > 1):
+        raise ValueError('Some nodes of the river graph have more than one child')
+    child = numpy.full(node_count, -1, dtype=numpy.int64)
+    child[source] = target
+    network = child_to_network(pixel_number, child)
+    pixel_number = network['pixel_number']
+
+    for attribute_name in attribute_names:
+        network[attribute_name] = numpy.fromiter((river_graph.nodes[node][attribute_name] for node in
+                                                  pixel_number.tolist()), dtype=numpy.float64, count=node_count)
+    return network
+
+
+def child_to_network(pixel_number: numpy.ndarray, child: numpy.ndarray) -> dict:
+    """
+     Creates the arrays of a network, see graph_to_network, from the child of every node.
+     :rtype: dict
+     :pixel_number: numpy.ndarray: the identifier of every node.
+     :child: numpy.ndarray: the index of the child of every node in pixel_number, or -1 if the node has no child.
+     :return: a dictionary with the arrays 'pixel_number', 'child', 'parent_pointer', 'parent_index', 'level_pointer'
+     and the pixel index of add_pixel_index, in level order.
+     """
+    node_count = len(pixel_number)
+    target = child[child >= 0]
+
+    # determine the depth levels. A node joins the front once all its parents are in earlier levels.
+    remaining_parents = numpy.bincount(target, minlength=node_count)
+    level = numpy.full(node_count, -1, dtype=numpy.int64)
+    front = numpy.flatnonzero(remaining_parents == 0)
+    depth = 0
+    while len(front) > 0:
+        level[front] = depth
+        children = child[front]
+        children = children[children >= 0]
+        numpy.subtract.at(remaining_parents, children, 1)
+        children = numpy.unique(children)
+        front = children[remaining_parents[children] == 0]
+        depth += 1
+    if numpy.any(level < 0):
+        raise ValueError('The river graph contains a cycle')
+
+    # index the nodes level by level. Within a level, nodes that share a child are placed next to each other.
+    order = numpy.lexsort((numpy.arange(node_count), child, level))
+    rank = numpy.empty(node_count, dtype=numpy.int64)
+    rank[order] = numpy.arange(node_count)
+    pixel_number = pixel_number[order]
+    child = child[order]
+    child[child >= 0] = rank[child[child >= 0]]
+
+    # parents in compressed sparse row form
+    source = numpy.flatnonzero(child >= 0)
+    target = child[source]
+    parent_pointer = numpy.zeros(node_count + 1, dtype=numpy.int64)
+    parent_pointer[1:] = numpy.cumsum(numpy.bincount(target, minlength=node_count))
+    level_pointer = numpy.zeros(depth + 1, dtype=numpy.int64)
+    level_pointer[1:] = numpy.cumsum(numpy.bincount(level, minlength=depth))
+
+    network = {'pixel_number': pixel_number, 'child': child, 'parent_pointer': parent_pointer,
+               'parent_index': source[numpy.argsort(target, kind='stable')], 'level_pointer': level_pointer}
+    add_pixel_index(network)
+    return network
+
+
+def add_pixel_index(network: dict) -> dict:
+    """
+     Adds the arrays 'sorted_pixel_number' and 'sorted_index' to a network, such that pixel numbers can be translated
+     to node indices with a binary search. The node index is the dense counterpart of the pixel number: the nodes are
+     numbered 0 to N - 1 in the order of network['pixel_number'].
+     :rtype: dict
+     :network: dict: the network created by graph_to_network.
+     :return: the network with the additional arrays.
+     """
+    order = numpy.argsort(network['pixel_number'], kind='stable')
+    network['sorted_pixel_number'] = network['pixel_number'][order]
+    network['sorted_index'] = order
+    return network
+
+
+def pixels_to_index(network: dict, pixel_numbers, missing: int = None) -> numpy.ndarray:
+    """
+     Translates pixel numbers to node indices of the network.
+     :rtype: numpy.ndarray
+     :network: dict: the network created by graph_to_network.
+     :pixel_numbers: array-like: the pixel numbers to translate.
+     :missing: int: the index given to pixel numbers that are not in the network. If None, a KeyError is raised.
+     :return: an array with the node indices.
+     """
+    if 'sorted_pixel_number' in network:
+        sorted_pixels = network['sorted_pixel_number']
+        order = network['sorted_index']
+    else:
+        order = numpy.argsort(network['pixel_number'], kind='stable')
+        sorted_pixels = network['pixel_number'][order]
+    pixel_numbers = numpy.asarray(pixel_numbers, dtype=numpy.int64)
+
+    position = numpy.searchsorted(sorted_pixels, pixel_numbers)
+    position[position == len(sorted_pixels)] = 0
+    found = sorted_pixels[position] == pixel_numbers
+    index = order[position]
+    if not numpy.all(found):
+        if missing is None:
+            raise KeyError('Some pixel numbers are not in the network, e.g. ' + str(pixel_numbers[~found][0]))
+        index = numpy.where(found, index, missing)
+    return index
+
+
+def index_to_pixels(network: dict, node_index) -> numpy.ndarray:
+    """
+     Translates node indices of the network to pixel numbers.
+     :rtype: numpy.ndarray
+     :network: dict: the network created by graph_to_network.
+     :node_index: array-like: the node indices to translate.
+     :return: an array with the pixel numbers.
+     """
+    return network['pixel_number'][numpy.asarray(node_index, dtype=numpy.int64)]
+
+
+def table_to_index(network: dict, table: pandas.DataFrame, column: str = 'pixel_number',
+                   missing: int = None) -> numpy.ndarray:
+    """
+     Translates a column of pixel numbers of a table, e.g. the contamination dataframe or the observations, to node
+     indices of the network.
+     :rtype: numpy.ndarray
+     :network: dict: the network created by graph_to_network.
+     :table: pandas.DataFrame: the table.
+     :column: str: the column with the pixel numbers, e.g. 'pixel_number' or 'locations'.
+     :missing: int: the index given to pixel numbers that are not in the network. If None, a KeyError is raised.
+     :return: an array with the node index of every row.
+     """
+    return pixels_to_index(network, table[column].to_numpy(), missing)
+
+
+def basins_to_index(network: dict, basins: list) -> list:
+    """
+     Translates lists of pixel numbers, e.g. the basins of graph_functions.create_basin_lists, to node indices of the
+     network in a single search.
+     :rtype: list
+     :network: dict: the network created by graph_to_network.
+     :basins: list: a list with a list of pixel numbers for every basin.
+     :return: a list with an array of node indices for every basin.
+     """
+    lengths = [len(basin) for basin in basins]
+    pixel_numbers = numpy.fromiter((pixel for basin in basins for pixel in basin), dtype=numpy.int64,
+                                   count=sum(lengths))
+    return numpy.split(pixels_to_index(network, pixel_numbers), numpy.cumsum(lengths)[:-1])
+
+
+def plant_loads(contamination_df: pandas.DataFrame, parameters: list, pollution=None) -> numpy.ndarray:
+    """
+     Calculates the contaminant load discharged by each treatment plant, with the same formula as
+     graph_functions.run_model.
+     :rtype: numpy.ndarray
+     :contamination_df: pandas.DataFrame: A dataframe of contamination containing the discharge points.
+     :parameters: list: A list of the parameters in the model, including excretion, attenuation, filtered efficacy,
+                        primary efficacy, secondary efficacy and tertiary efficacy. If pollution is supplied, the
+                        excretion may be a list with a value for every contaminant.
+     :pollution: pandas.DataFrame or numpy.ndarray: optional, the pollution of every plant (rows) for every contaminant
+     (columns). If None, the field 'pollution' of contamination_df is used.
+     :return: the load of every row in contamination_df, with a column for every contaminant if pollution is supplied.
+     """
+    excretion, attenuation, filt_eff, primary_eff, secondary_eff, tertiary_eff = parameters
+    treatment_level = contamination_df["Treatment_level"].to_numpy()
+    treatment_efficacy = primary_eff * (treatment_level == 1) + secondary_eff * (treatment_level == 2) + \
+        tertiary_eff * (treatment_level == 3)
+    contamination = (1 - treatment_efficacy) * contamination_df["Treat_a"].to_numpy() + (1 - filt_eff) * \
+        contamination_df["Filt_a"].to_numpy() + contamination_df["Unfilt_a"].to_numpy()
+    if pollution is None:
+        return contamination * contamination_df["pollution"].to_numpy() * excretion
+    return contamination[:, None] * numpy.asarray(pollution, dtype=numpy.float64) * numpy.asarray(excretion)
+
+
+def load_classes(contamination_df: pandas.DataFrame) -> numpy.ndarray:
+    """
+     Splits the load of every discharge point into the six classes on which it depends linearly: untreated, primary,
+     secondary and tertiary treated, filtered and unfiltered population equivalents, each multiplied by the pollution.
+     The loads of plant_loads are these classes multiplied by the coefficients of class_coefficients.
+     :rtype: numpy.ndarray
+     :contamination_df: pandas.DataFrame: A dataframe of contamination containing the discharge points.
+     :return: an array with a row for every row of contamination_df and a column for every class.
+     """
+    treatment_level = contamination_df["Treatment_level"].to_numpy()
+    treated = contamination_df["Treat_a"].to_numpy()
+    classes = numpy.column_stack([treated * ~numpy.isin(treatment_level, [1, 2, 3]), treated * (treatment_level == 1),
+                                  treated * (treatment_level == 2), treated * (treatment_level == 3),
+                                  contamination_df["Filt_a"].to_numpy(), contamination_df["Unfilt_a"].to_numpy()])
+    return classes * contamination_df["pollution"].to_numpy()[:, None]
+
+
+def class_coefficients(parameter_matrix: numpy.ndarray) -> numpy.ndarray:
+    """
+     Gives the coefficients of the load classes of load_classes for a set of parameter vectors.
+     :rtype: numpy.ndarray
+     :parameter_matrix: numpy.ndarray: an array with a row [excretion, attenuation, filt_eff, primary_eff,
+     secondary_eff, tertiary_eff] for every run.
+     :return: an array with a row for every class and a column for every run.
+     """
+    parameter_matrix = numpy.atleast_2d(numpy.asarray(parameter_matrix, dtype=numpy.float64))
+    excretion, attenuation, filt_eff, primary_eff, secondary_eff, tertiary_eff = parameter_matrix.T
+    ones = numpy.ones(len(parameter_matrix))
+    return numpy.array([ones, 1 - primary_eff, 1 - secondary_eff, 1 - tertiary_eff, 1 - filt_eff, ones]) * excretion
+
+
+def initial_loads(network: dict, contamination_df: pandas.DataFrame, loads: numpy.ndarray) -> numpy.ndarray:
+    """
+     Sums the loads of the discharge points per node of the network.
+     :rtype: numpy.ndarray
+     :network: dict: the network created by graph_to_network.
+     :contamination_df: pandas.DataFrame: A dataframe of contamination containing the discharge points.
+     :loads: numpy.ndarray: the load of every row in contamination_df. If it has columns, every column is summed.
+     :return: an array with the initial load of every node, with the same columns as loads.
+     """
+    location = table_to_index(network, contamination_df)
+    loads = numpy.asarray(loads, dtype=numpy.float64)
+    if loads.ndim == 1:
+        return numpy.bincount(location, weights=loads, minlength=len(network['pixel_number']))
+
+    node_loads = numpy.zeros((len(network['pixel_number']),) + loads.shape[1:])
+    numpy.add.at(node_loads, location, loads)
+    return node_loads
+
+
+def propagate(network: dict, initial_load: numpy.ndarray, decay: numpy.ndarray = None) -> numpy.ndarray:
+    """
+     Propagates loads downstream. The load of a node is the sum of its initial load and the loads of its parents,
+     multiplied by the decay of the node. All nodes of a depth level are handled at once, so the amount of python
+     iterations equals the length of the longest river instead of the amount of nodes.
+     :rtype: numpy.ndarray
+     :network: dict: the network created by graph_to_network.
+     :initial_load: numpy.ndarray: the initial load of every node. It may have a column for every run, such that
+     many runs (parameter vectors, contaminants, scenarios) are propagated in a single pass.
+     :decay: numpy.ndarray: the fraction of the load that remains after passing a node. It either has one value per
+     node or the same shape as initial_load. If None, nothing decays.
+     :return: an array with the load of every node, with the same shape as initial_load.
+     """
+    load = numpy.array(initial_load, dtype=numpy.float64)
+    child = network['child']
+    level_pointer = network['level_pointer']
+    if decay is not None:
+        decay = numpy.asarray(decay, dtype=numpy.float64)
+        if decay.ndim < load.ndim:
+            decay = decay.reshape(decay.shape + (1,) * (load.ndim - decay.ndim))
+
+    for level in range(len(level_pointer) - 1):
+        start, end = level_pointer[level], level_pointer[level + 1]
+        if decay is not None:
+            load[start:end] *= decay[start:end]
+        children = child[start:end]
+        has_child = children >= 0
+        # children are always in a later level, so their load can be accumulated in place.
+        numpy.add.at(load, children[has_child], load[start:end][has_child])
+    return load
+
+
+def node_levels(network: dict) -> numpy.ndarray:
+    """
+     Gives the depth level of every node of a network.
+     :rtype: numpy.ndarray
+     :network: dict: the network created by graph_to_network.
+     :return: an array with the level of every node.
+     """
+    return numpy.repeat(numpy.arange(len(network['level_pointer']) - 1), numpy.diff(network['level_pointer']))
+
+
+def basin_outlets(network: dict) -> numpy.ndarray:
+    """
+     Gives the outlet of every node. Nodes with the same outlet form a basin, i.e. a connected component of the river
+     graph.
+     :rtype: numpy.ndarray
+     :network: dict: the network created by graph_to_network.
+     :return: an array with the index of the outlet of every node.
+     """
+    child = network['child']
+    level_pointer = network['level_pointer']
+    outlet = numpy.arange(len(child))
+    # the deepest levels first, such that the outlet of the child is known
+    for level in range(len(level_pointer) - 2, -1, -1):
+        start, end = level_pointer[level], level_pointer[level + 1]
+        children = child[start:end]
+        outlet[start:end] = numpy.where(children >= 0, outlet[children], outlet[start:end])
+    return outlet
+
+
+def subnetwork(network: dict, node_index: numpy.ndarray) -> dict:
+    """
+     Extracts the nodes node_index of a network as a new network. The parents and the child of every node must be
+     part of node_index or be left out on purpose, e.g. by extracting whole basins.
+     :rtype: dict
+     :network: dict: the network created by graph_to_network.
+     :node_index: numpy.ndarray: the indices of the nodes to extract.
+     :return: a network with the same fields, whose nodes are in the order of the original network.
+     """
+    node_index = numpy.unique(node_index)
+    node_count = len(network['pixel_number'])
+    rank = numpy.full(node_count, -1, dtype=numpy.int64)
+    rank[node_index] = numpy.arange(len(node_index))
+
+    child = network['child'][node_index]
+    child[child >= 0] = rank[child[child >= 0]]
+    level = node_levels(network)[node_index]
+    depth = level[-1] + 1 if len(level) > 0 else 0
+
+    source = numpy.flatnonzero(child >= 0)
+    target = child[source]
+    parent_pointer = numpy.zeros(len(node_index) + 1, dtype=numpy.int64)
+    parent_pointer[1:] = numpy.cumsum(numpy.bincount(target, minlength=len(node_index)))
+    level_pointer = numpy.zeros(depth + 1, dtype=numpy.int64)
+    level_pointer[1:] = numpy.cumsum(numpy.bincount(level, minlength=depth))
+
+    sub = {'pixel_number': network['pixel_number'][node_index], 'child': child, 'parent_pointer': parent_pointer,
+           'parent_index': source[numpy.argsort(target, kind='stable')], 'level_pointer': level_pointer}
+    add_pixel_index(sub)
+    for field_name, values in network.items():
+        if field_name not in sub and isinstance(values, numpy.ndarray) and len(values) == node_count:
+            sub[field_name] = values[node_index]
+    return sub
+
+
+def basin_work_units(network: dict, unit_count: int) -> list:
+    """
+     Divides the basins of a network into work units with about the same amount of nodes. The largest basins are
+     assigned first, each to the unit with the fewest nodes so far.
+     :rtype: list
+     :network: dict: the network created by graph_to_network.
+     :unit_count: int: the amount of work units.
+     :return: a list with an array of node indices for every non-empty work unit.
+     """
+    outlet = basin_outlets(network)
+    basins, basin_of_node, basin_size = numpy.unique(outlet, return_inverse=True, return_counts=True)
+
+    units = [(0, unit) for unit in range(unit_count)]
+    unit_of_basin = numpy.empty(len(basins), dtype=numpy.int64)
+    for basin in numpy.argsort(-basin_size, kind='stable'):
+        size, unit = heapq.heappop(units)
+        unit_of_basin[basin] = unit
+        heapq.heappush(units, (size + basin_size[basin], unit))
+
+    unit_of_node = unit_of_basin[basin_of_node]
+    order = numpy.argsort(unit_of_node, kind='stable')
+    node_indices = numpy.split(order, numpy.cumsum(numpy.bincount(unit_of_node, minlength=unit_count))[:-1])
+    return [node_index for node_index in node_indices if len(node_index) > 0]
+
+
+@contextmanager
+def publish_arrays(arrays: dict):
+    """
+     Copies arrays, e.g. the arrays of a network, into shared memory blocks once. Other processes can attach to the
+     blocks with attach_arrays instead of receiving a pickled copy. The blocks are removed when the context ends.
+     :rtype: dict
+     :arrays: dict: names as keys and numpy arrays as values.
+     :return: a descriptor with the names as keys and [block name, shape, dtype] as values. It is small and can be
+     passed to other processes.
+     """
+    blocks = []
+    descriptor = {}
+    try:
+        for name, values in arrays.items():
+            values = numpy.ascontiguousarray(values)
+            block = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+            blocks.append(block)
+            numpy.ndarray(values.shape, dtype=values.dtype, buffer=block.buf)[...] = values
+            descriptor[name] = [block.name, values.shape, values.dtype.str]
+        yield descriptor
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+
+@contextmanager
+def attach_arrays(descriptor: dict):
+    """
+     Attaches to the shared memory blocks of publish_arrays and gives them as numpy arrays, without copying. The
+     arrays must not be used after the context ends.
+     :rtype: dict
+     :descriptor: dict: the descriptor given by publish_arrays.
+     :return: a dictionary with the names as keys and the shared arrays as values.
+     """
+    blocks = []
+    arrays = {}
+    try:
+        for name, (block_name, shape, dtype) in descriptor.items():
+            # only the publishing process removes the block. Worker processes share its resource tracker, so
+            # attaching does not register the block a second time.
+            if sys.version_info >= (3, 13):
+                block = shared_memory.SharedMemory(name=block_name, track=False)
+            else:
+                block = shared_memory.SharedMemory(name=block_name)
+            blocks.append(block)
+            arrays[name] = numpy.ndarray(shape, dtype=dtype, buffer=block.buf)
+        yield arrays
+    finally:
+        arrays.clear()
+        for block in blocks:
+            block.close()
+
+
+def propagate_unit(descriptor: dict, node_index: numpy.ndarray) -> numpy.ndarray:
+    """
+     Propagates one work unit of propagate_parallel in a worker process, using the shared arrays of the network.
+     :rtype: numpy.ndarray
+     :descriptor: dict: the descriptor given by publish_arrays for the network structure, 'initial_load' and
+     optionally 'decay'.
+     :node_index: numpy.ndarray: the indices of the nodes of the work unit, consisting of whole basins.
+     :return: the load of the nodes of the work unit.
+     """
+    with attach_arrays(descriptor) as arrays:
+        unit = subnetwork(arrays, node_index)
+        load = propagate(unit, unit['initial_load'], unit.get('decay'))
+        unit = None
+    return load
+
+
+def propagate_parallel(network: dict, initial_load: numpy.ndarray, decay: numpy.ndarray = None,
+                       workers: int = None, unit_count: int = None) -> numpy.ndarray:
+    """
+     Propagates loads like propagate, but divides the basins over work units that are propagated in separate
+     processes. The network and the loads are published in shared memory once, so the workers receive only the node
+     indices of their work unit. The results are gathered into one array.
+     :rtype: numpy.ndarray
+     :network: dict: the network created by graph_to_network.
+     :initial_load: numpy.ndarray: the initial load of every node, optionally with a column for every run.
+     :decay: numpy.ndarray: the fraction of the load that remains after passing a node. It either has one value per
+     node or the same shape as initial_load. If None, nothing decays.
+     :workers: int: the amount of processes. Defaults to the amount of cpus.
+     :unit_count: int: the amount of work units. Defaults to the amount of workers.
+     :return: an array with the load of every node, with the same shape as initial_load.
+     """
+    if workers is None:
+        workers = os.cpu_count()
+    if unit_count is None:
+        unit_count = workers
+    initial_load = numpy.asarray(initial_load, dtype=numpy.float64)
+    arrays = {field_name: network[field_name] for field_name in
+              ['pixel_number', 'child', 'parent_pointer', 'parent_index', 'level_pointer']}
+    arrays['initial_load'] = initial_load
+    if decay is not None:
+        arrays['decay'] = numpy.asarray(decay, dtype=numpy.float64)
+
+    load = numpy.empty(initial_load.shape)
+    with publish_arrays(arrays) as descriptor, ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(propagate_unit, descriptor, node_index): node_index
+                   for node_index in basin_work_units(network, unit_count)}
+        for future, node_index in futures.items():
+            load[node_index] = future.result()
+    return load
+
+
+def run_model_parallel(network: dict, contamination_df: pandas.DataFrame, parameters: list, scenario: str = '',
+                       workers: int = None, unit_count: int = None) -> list:
+    """
+     This functions gives the same results as run_model, but propagates the basins in parallel processes, see
+     propagate_parallel. On Windows, the calling script must be guarded by if __name__ == '__main__'.
+     :rtype: list
+     :network: dict: the network created by graph_to_network. It must contain the residence time and discharge fields
+     of the scenario.
+     :contamination_df: pandas.DataFrame: A dataframe of contamination containing the discharge points.
+     :parameters: list: A list of the parameters in the model, including excretion, attenuation, filtered efficacy,
+                        primary efficacy, secondary efficacy and tertiary efficacy.
+     :scenario: string: the scenario to be run. The default gives the hydroRIVERS scenario.
+     :workers: int: the amount of processes. Defaults to the amount of cpus.
+     :unit_count: int: the amount of work units. Defaults to the amount of workers.
+     :return: the load and the concentration of every node, in the order of network['pixel_number'].
+     """
+    cont, RT, dis, rel_cont = scenario_fields(scenario)
+    init_load = initial_loads(network, contamination_df, plant_loads(contamination_df, parameters))
+    load = propagate_parallel(network, init_load, numpy.exp(-parameters[1] * network[RT]), workers, unit_count)
+    return [load, load / network[dis]]
+
+
+def scenario_fields(scenario: str = '', output_field_name: str = '') -> list:
+    """
+     Gives the names of the fields that run_model uses for a scenario.
+     :rtype: list
+     :scenario: string: the scenario to be run. The default gives the hydroRIVERS scenario.
+     :output_field_name: string: overrides the name of the output fields if it is not empty.
+     :return: the names of the load, residence time, discharge and concentration fields.
+     """
+    if scenario == '':
+        cont = "absolute load"
+        RT = "RT_HR"
+        dis = "flow_HR"
+        rel_cont = "concentration"
+    else:
+        cont = "absolute load " + scenario
+        RT = "RT_" + scenario
+        dis = scenario
+        rel_cont = "concentration " + scenario
+
+    if output_field_name != '':
+        cont = "Contaminant " + output_field_name
+        rel_cont = "Relative contaminant " + output_field_name
+    return [cont, RT, dis, rel_cont]
+
+
+def run_model(network: dict, contamination_df: pandas.DataFrame, parameters: list, scenario: str = '',
+              river_graph: networkx.DiGraph = None, output_field_name: str = '', pollution=None) -> list:
+    """
+     This functions takes a network, a contamination dataframe and parameters to calculate contamination in the river
+     network. It gives the same results as graph_functions.run_model, but never touches the graph unless asked.
+     :rtype: list
+     :network: dict: the network created by graph_to_network. It must contain the residence time and discharge fields
+     of the scenario.
+     :contamination_df: pandas.DataFrame: A dataframe of contamination containing the discharge points.
+     :parameters: list: A list of the parameters in the model, including excretion, attenuation, filtered efficacy,
+                        primary efficacy, secondary efficacy and tertiary efficacy. If pollution is supplied, the
+                        excretion and the attenuation may be lists with a value for every contaminant.
+     :scenario: string: the scenario to be run. The default gives the hydroRIVERS scenario.
+     :river_graph: networkx.DiGraph: if supplied, the results are written to the graph with the field names of
+     graph_functions.run_model. With several contaminants, the name of the contaminant is added to the field names.
+     :output_field_name: string: the output field of the graph. If this field is left empty, the output field will be
+     set by default.
+     :pollution: pandas.DataFrame or numpy.ndarray: optional, the pollution of every plant (rows) for every contaminant
+     (columns). All contaminants are propagated together in a single traversal.
+     :return: the load and the concentration of every node, in the order of network['pixel_number']. With several
+     contaminants, these have a column for every contaminant.
+     """
+    cont, RT, dis, rel_cont = scenario_fields(scenario, output_field_name)
+    attenuation = numpy.asarray(parameters[1], dtype=numpy.float64)
+
+    init_load = initial_loads(network, contamination_df, plant_loads(contamination_df, parameters, pollution))
+    load = propagate(network, init_load, numpy.exp(-numpy.multiply.outer(network[RT], attenuation)))
+    concentration = load / network[dis].reshape((-1,) + (1,) * (load.ndim - 1))
+
+    if river_graph is not None:
+        if load.ndim == 1:
+            network_to_graph(river_graph, network, {cont: load, rel_cont: concentration})
+        else:
+            names = pollution.columns if isinstance(pollution, pandas.DataFrame) else range(load.shape[1])
+            fields = {}
+            for j, name in enumerate(names):
+                fields[cont + " " + str(name)] = load[:, j]
+                fields[rel_cont + " " + str(name)] = concentration[:, j]
+            network_to_graph(river_graph, network, fields)
+    return [load, concentration]
+
+
+def run_model_batch(network: dict, contamination_df: pandas.DataFrame, parameter_matrix: numpy.ndarray,
+                    scenario: str = '') -> list:
+    """
+     This functions runs the model for many parameter vectors in a single traversal of the network. This allows
+     optimizers to evaluate a whole simplex, grid or population at once.
+     :rtype: list
+     :network: dict: the network created by graph_to_network. It must contain the residence time and discharge fields
+     of the scenario.
+     :contamination_df: pandas.DataFrame: A dataframe of contamination containing the discharge points.
+     :parameter_matrix: numpy.ndarray: an array with a row [excretion, attenuation, filt_eff, primary_eff,
+     secondary_eff, tertiary_eff] for every run.
+     :scenario: string: the scenario to be run. The default gives the hydroRIVERS scenario.
+     :return: the load and the concentration as arrays with a row for every node, in the order of
+     network['pixel_number'], and a column for every parameter vector.
+     """
+    cont, RT, dis, rel_cont = scenario_fields(scenario)
+    parameter_matrix = numpy.atleast_2d(numpy.asarray(parameter_matrix, dtype=numpy.float64))
+    attenuation = parameter_matrix[:, 1]
+
+    loads = load_classes(contamination_df) @ class_coefficients(parameter_matrix)
+    init_load = initial_loads(network, contamination_df, loads)
+    load = propagate(network, init_load, numpy.exp(-numpy.outer(network[RT], attenuation)))
+    concentration = load / network[dis][:, None]
+
+    return [load, concentration]
+
+
+def class_responses(network: dict, contamination_df: pandas.DataFrame, attenuation: float,
+                    scenario: str = '') -> dict:
+    """
+     Propagates every load class of load_classes separately for a given attenuation. Since the model is linear in the
+     loads, the results for any excretion and treatment efficacies are a weighted sum of these responses, see
+     combine_responses.
+     :rtype: dict
+     :network: dict: the network created by graph_to_network. It must contain the residence time and discharge fields
+     of the scenario.
+     :contamination_df: pandas.DataFrame: A dataframe of contamination containing the discharge points.
+     :attenuation: float: the attenuation of the responses.
+     :scenario: string: the scenario to be run. The default gives the hydroRIVERS scenario.
+     :return: a dictionary with the 'attenuation', the 'scenario', the 'load' of every class as an array with a row for
+     every node and a column for every class, and the 'discharge' of every node.
+     """
+    cont, RT, dis, rel_cont = scenario_fields(scenario)
+    init_load = initial_loads(network, contamination_df, load_classes(contamination_df))
+    load = propagate(network, init_load, numpy.exp(-attenuation * network[RT]))
+    return {'attenuation': attenuation, 'scenario': scenario, 'load': load, 'discharge': network[dis]}
+
+
+def combine_responses(responses: dict, parameters) -> list:
+    """
+     Calculates the load and the concentration of every node from the responses of class_responses, without
+     traversing the network.
+     :rtype: list
+     :responses: dict: the responses created by class_responses.
+     :parameters: list or numpy.ndarray: A list of the parameters in the model, including excretion, attenuation,
+                        filtered efficacy, primary efficacy, secondary efficacy and tertiary efficacy, or an array with
+                        such a row for every run. The attenuation must be the one of the responses.
+     :return: the load and the concentration of every node, in the order of network['pixel_number']. For an array of
+     parameters, these have a column for every run.
+     """
+    parameter_matrix = numpy.asarray(parameters, dtype=numpy.float64)
+    if not numpy.all(numpy.atleast_2d(parameter_matrix)[:, 1] == responses['attenuation']):
+        raise ValueError('The attenuation differs from the attenuation of the responses: ' +
+                         str(responses['attenuation']))
+
+    load = responses['load'] @ class_coefficients(parameter_matrix)
+    if parameter_matrix.ndim == 1:
+        load = load[:, 0]
+    concentration = load / responses['discharge'].reshape((-1,) + (1,) * (load.ndim - 1))
+    return [load, concentration]
+
+
+def create_model_state(network: dict, contamination_df: pandas.DataFrame, parameters: list,
+                       scenario: str = '') -> dict:
+    """
+     Runs the model once and keeps everything that is needed to update the results after small edits, see
+     update_model_state.
+     :rtype: dict
+     :network: dict: the network created by graph_to_network. It must contain the residence time and discharge fields
+     of the scenario.
+     :contamination_df: pandas.DataFrame: A dataframe of contamination containing the discharge points.
+     :parameters: list: A list of the parameters in the model, including excretion, attenuation, filtered efficacy,
+                        primary efficacy, secondary efficacy and tertiary efficacy.
+     :scenario: string: the scenario to be run. The default gives the hydroRIVERS scenario.
+     :return: a dictionary with the 'attenuation' and the arrays 'initial_load', 'decay', 'discharge', 'load' and
+     'concentration', in the order of network['pixel_number'].
+     """
+    cont, RT, dis, rel_cont = scenario_fields(scenario)
+    init_load = initial_loads(network, contamination_df, plant_loads(contamination_df, parameters))
+    decay = numpy.exp(-parameters[1] * network[RT])
+    discharge = numpy.array(network[dis], dtype=numpy.float64)
+    load = propagate(network, init_load, decay)
+    return {'attenuation': parameters[1], 'initial_load': init_load, 'decay': decay, 'discharge': discharge,
+            'load': load, 'concentration': load / discharge}
+
+
+def update_model_state(state: dict, network: dict, initial_load: dict = None, RT: dict = None,
+                       discharge: dict = None) -> numpy.ndarray:
+    """
+     Applies edits to a model state and recomputes only the nodes downstream of the edited nodes. Since every node has
+     at most one child, this is a single path per edited node.
+     :rtype: numpy.ndarray
+     :state: dict: the model state created by create_model_state. It is updated in place.
+     :network: dict: the network created by graph_to_network.
+     :initial_load: dict: pixel numbers as keys and their new initial load as values, e.g. after a plant changed its
+     treatment level.
+     :RT: dict: pixel numbers as keys and their new residence time as values.
+     :discharge: dict: pixel numbers as keys and their new discharge as values. The discharge does not change the
+     loads, so only the concentration of these nodes is recomputed.
+     :return: the indices of the nodes whose results were recomputed, in the order of network['pixel_number'].
+     """
+    child = network['child']
+    parent_pointer = network['parent_pointer']
+    parent_index = network['parent_index']
+    load = state['load']
+
+    edited = []
+    if initial_load:
+        index = pixels_to_index(network, list(initial_load.keys()))
+        state['initial_load'][index] = list(initial_load.values())
+        edited.extend(index.tolist())
+    if RT:
+        index = pixels_to_index(network, list(RT.keys()))
+        state['decay'][index] = numpy.exp(-state['attenuation'] * numpy.array(list(RT.values()), dtype=numpy.float64))
+        edited.extend(index.tolist())
+    changed = set()
+    if discharge:
+        index = pixels_to_index(network, list(discharge.keys()))
+        state['discharge'][index] = list(discharge.values())
+        changed.update(index.tolist())
+
+    # the downstream paths of the edited nodes. A path can stop once it reaches a path that was already collected.
+    dirty = set()
+    for node in edited:
+        while node >= 0 and node not in dirty:
+            dirty.add(node)
+            node = child[node]
+
+    # parents have a smaller index than their children, so increasing indices are a valid order of computation
+    for node in sorted(dirty):
+        parents = parent_index[parent_pointer[node]:parent_pointer[node + 1]]
+        load[node] = (state['initial_load'][node] + load[parents].sum()) * state['decay'][node]
+    changed = numpy.array(sorted(changed.union(dirty)), dtype=numpy.int64)
+    state['concentration'][changed] = load[changed] / state['discharge'][changed]
+    return changed
+
+
+def run_scenarios(network: dict, contamination_df: pandas.DataFrame, parameters: list, scenarios: list,
+                  river_graph: networkx.DiGraph = None, limit: float = None, write_scenarios: bool = False) -> list:
+    """
+     This functions runs the model for several flow scenarios in a single traversal of the network. The residence time
+     and discharge fields of all scenarios are stacked as columns, such that every scenario is propagated at once.
+     :rtype: list
+     :network: dict: the network created by graph_to_network. It must contain the residence time and discharge fields
+     of every scenario, e.g. 'RT_flow1' and 'flow1'.
+     :contamination_df: pandas.DataFrame: A dataframe of contamination containing the discharge points.
+     :parameters: list: A list of the parameters in the model, including excretion, attenuation, filtered efficacy,
+                        primary efficacy, secondary efficacy and tertiary efficacy.
+     :scenarios: list: the scenarios to be run, e.g. ['flow1', ..., 'flow9']. '' gives the hydroRIVERS scenario.
+     :river_graph: networkx.DiGraph: if supplied, the summaries of scenario_summary are written to the graph.
+     :limit: float: the concentration limit used for the exceedance summary.
+     :write_scenarios: bool: if True, the load and concentration of every scenario are also written to the graph, with
+     the field names of run_model.
+     :return: the load and the concentration as arrays with a row for every node, in the order of
+     network['pixel_number'], and a column for every scenario.
+     """
+    fields = [scenario_fields(scenario) for scenario in scenarios]
+    residence_time = numpy.column_stack([network[RT] for cont, RT, dis, rel_cont in fields])
+    discharge = numpy.column_stack([network[dis] for cont, RT, dis, rel_cont in fields])
+
+    # the initial load does not depend on the flow, so it is repeated for every scenario
+    init_load = initial_loads(network, contamination_df, plant_loads(contamination_df, parameters))
+    init_load = numpy.repeat(init_load[:, None], len(scenarios), axis=1)
+    load = propagate(network, init_load, numpy.exp(-parameters[1] * residence_time))
+    concentration = load / discharge
+
+    if river_graph is not None:
+        graph_fields = scenario_summary(concentration, limit)
+        if write_scenarios:
+            for j, (cont, RT, dis, rel_cont) in enumerate(fields):
+                graph_fields[cont] = load[:, j]
+                graph_fields[rel_cont] = concentration[:, j]
+        network_to_graph(river_graph, network, graph_fields)
+    return [load, concentration]
+
+
+def scenario_summary(concentration: numpy.ndarray, limit: float = None) -> dict:
+    """
+     Summarises the concentrations of several scenarios per node.
+     :rtype: dict
+     :concentration: numpy.ndarray: an array with a row for every node and a column for every scenario, as given by
+     run_scenarios.
+     :limit: float: the concentration limit. If supplied, the fraction of scenarios above the limit is added.
+     :return: a dictionary with the fields 'concentration mean', 'concentration min', 'concentration max' and, if a
+     limit is supplied, 'concentration exceedance'.
+     """
+    summary = {"concentration mean": concentration.mean(axis=1), "concentration min": concentration.min(axis=1),
+               "concentration max": concentration.max(axis=1)}
+    if limit is not None:
+        summary["concentration exceedance"] = (concentration > limit).mean(axis=1)
+    return summary
+
+
+def reach_network(network: dict, contamination_df: pandas.DataFrame, scenario: str = '') -> dict:
+    """
+     Collapses the chains of a network into reaches. A reach starts at every headwater, every confluence and every
+     discharge point, and continues downstream as long as the next node has a single parent and no discharge point.
+     Within a reach, the load only decays: the load of a member is the load entering the reach multiplied by
+     exp(-attenuation * the residence time of the reach up to and including the member). The reaches form a network
+     themselves, on which the model runs with far fewer nodes, see run_reach_model and reach_results.
+     :rtype: dict
+     :network: dict: the network created by graph_to_network. It must contain the residence time field of the
+     scenario.
+     :contamination_df: pandas.DataFrame: A dataframe of contamination containing the discharge points.
+     :scenario: string: the scenario whose residence times are summed. The default gives the hydroRIVERS scenario.
+     :return: a network of reaches, whose 'pixel_number' is the pixel number of the first member and whose residence
+     time field is the total residence time of the reach. It also contains 'reach_of_node' and 'cumulative_RT', with a
+     value for every node of the network.
+     """
+    cont, RT, dis, rel_cont = scenario_fields(scenario)
+    child = network['child']
+    level_pointer = network['level_pointer']
+    node_count = len(child)
+
+    parent_count = numpy.diff(network['parent_pointer'])
+    start = parent_count != 1
+    start[table_to_index(network, contamination_df)] = True
+    # the parent of the nodes with a single parent
+    parent = numpy.full(node_count, -1, dtype=numpy.int64)
+    has_child = child >= 0
+    parent[child[has_child]] = numpy.flatnonzero(has_child)
+
+    reach_of_node = numpy.full(node_count, -1, dtype=numpy.int64)
+    reach_of_node[start] = numpy.arange(numpy.count_nonzero(start))
+    cumulative_RT = numpy.array(network[RT], dtype=numpy.float64)
+    for level in range(1, len(level_pointer) - 1):
+        nodes = numpy.arange(level_pointer[level], level_pointer[level + 1])
+        nodes = nodes[~start[nodes]]
+        reach_of_node[nodes] = reach_of_node[parent[nodes]]
+        cumulative_RT[nodes] += cumulative_RT[parent[nodes]]
+
+    # the last member of a reach flows into the first member of its child reach
+    first = numpy.flatnonzero(start)
+    last = numpy.flatnonzero(~has_child | start[numpy.where(has_child, child, 0)])
+    reach_child = numpy.full(len(first), -1, dtype=numpy.int64)
+    last_with_child = last[has_child[last]]
+    reach_child[reach_of_node[last_with_child]] = reach_of_node[child[last_with_child]]
+    total_RT = numpy.empty(len(first))
+    total_RT[reach_of_node[last]] = cumulative_RT[last]
+
+    reach = child_to_network(network['pixel_number'][first], reach_child)
+    # child_to_network reorders the reaches by level, so the reach numbers are translated
+    rank = pixels_to_index(reach, network['pixel_number'][first])
+    reach[RT] = numpy.empty(len(first))
+    reach[RT][rank] = total_RT
+    reach['reach_of_node'] = rank[reach_of_node]
+    reach['cumulative_RT'] = cumulative_RT
+    return reach
+
+
+def run_reach_model(reach: dict, contamination_df: pandas.DataFrame, parameters: list,
+                    scenario: str = '') -> numpy.ndarray:
+    """
+     Runs the model on the network of reaches of reach_network.
+     :rtype: numpy.ndarray
+     :reach: dict: the network of reaches created by reach_network, for the same contamination_df and scenario.
+     :contamination_df: pandas.DataFrame: A dataframe of contamination containing the discharge points.
+     :parameters: list: A list of the parameters in the model, including excretion, attenuation, filtered efficacy,
+                        primary efficacy, secondary efficacy and tertiary efficacy.
+     :scenario: string: the scenario to be run. The default gives the hydroRIVERS scenario.
+     :return: the load entering every reach, which reach_results turns into the results of its members.
+     """
+    cont, RT, dis, rel_cont = scenario_fields(scenario)
+    # every discharge point is the first member of a reach
+    init_load = initial_loads(reach, contamination_df, plant_loads(contamination_df, parameters))
+    end_load = propagate(reach, init_load, numpy.exp(-parameters[1] * reach[RT]))
+
+    entering_load = init_load
+    has_child = reach['child'] >= 0
+    numpy.add.at(entering_load, reach['child'][has_child], end_load[has_child])
+    return entering_load
+
+
+def reach_results(reach: dict, network: dict, entering_load: numpy.ndarray, parameters: list, pixel_numbers=None,
+                  scenario: str = '') -> list:
+    """
+     Calculates the load and the concentration of the requested nodes from the loads entering the reaches.
+     :rtype: list
+     :reach: dict: the network of reaches created by reach_network.
+     :network: dict: the network of the nodes. It must contain the discharge field of the scenario.
+     :entering_load: numpy.ndarray: the load entering every reach, as given by run_reach_model.
+     :parameters: list: the parameters given to run_reach_model.
+     :pixel_numbers: array-like: the nodes of interest. Defaults to all nodes, in the order of network['pixel_number'].
+     :scenario: string: the scenario to be run. The default gives the hydroRIVERS scenario.
+     :return: the load and the concentration of the requested nodes. They equal the results of run_model up to
+     rounding, since the decay of a reach is calculated as one exponential of the summed residence times.
+     """
+    cont, RT, dis, rel_cont = scenario_fields(scenario)
+    index = slice(None) if pixel_numbers is None else pixels_to_index(network, pixel_numbers)
+    load = entering_load[reach['reach_of_node'][index]] * numpy.exp(-parameters[1] * reach['cumulative_RT'][index])
+    return [load, load / network[dis][index]]
+
+
+def add_travel_time_index(network: dict, scenario: str = '') -> dict:
+    """
+     Adds a travel time index to a network. The travel time T of a node is the residence time from the node to the
+     outlet, including both. A load discharged at node s that reaches node n is then multiplied by
+     exp(-attenuation * (T_s - T_n + RT_n)). The nodes are also numbered in depth-first order from the outlets
+     upstream, such that the nodes upstream of node n (including n) are those with a 'preorder' between preorder[n] and
+     preorder[n] + upstream_count[n]. With this index, loads_at_nodes gives the loads at any node for any attenuation
+     without propagating the network.
+     :rtype: dict
+     :network: dict: the network created by graph_to_network. It must contain the residence time field of the
+     scenario.
+     :scenario: string: the scenario whose residence times are used. The default gives the hydroRIVERS scenario.
+     :return: the network with the arrays 'travel_time_' + the residence time field, 'preorder' and 'upstream_count'.
+     """
+    cont, RT, dis, rel_cont = scenario_fields(scenario)
+    child = network['child']
+    parent_pointer = network['parent_pointer']
+    parent_index = network['parent_index']
+    level_pointer = network['level_pointer']
+
+    upstream_count = propagate(network, numpy.ones(len(child)))
+    upstream_count = numpy.rint(upstream_count).astype(numpy.int64)
+    travel_time = numpy.array(network[RT], dtype=numpy.float64)
+    preorder = numpy.zeros(len(child), dtype=numpy.int64)
+    outlets = numpy.flatnonzero(child < 0)
+    preorder[outlets] = numpy.cumsum(upstream_count[outlets]) - upstream_count[outlets]
+
+    # from the outlets upstream: the child of every node is handled before the node itself
+    for level in range(len(level_pointer) - 2, -1, -1):
+        start, end = level_pointer[level], level_pointer[level + 1]
+        children = child[start:end]
+        has_child = children >= 0
+        travel_time[start:end][has_child] += travel_time[children[has_child]]
+
+        # the parents of a node get consecutive blocks after the node in the depth-first order
+        parents = parent_index[parent_pointer[start]:parent_pointer[end]]
+        if len(parents) > 0:
+            nodes = numpy.repeat(numpy.arange(start, end), numpy.diff(parent_pointer[start:end + 1]))
+            counts = upstream_count[parents]
+            before = numpy.cumsum(counts) - counts
+            group_start = before[parent_pointer[nodes] - parent_pointer[start]]
+            preorder[parents] = preorder[nodes] + 1 + before - group_start
+
+    network['travel_time_' + RT] = travel_time
+    network['preorder'] = preorder
+    network['upstream_count'] = upstream_count
+    return network
+
+
+def loads_at_nodes(network: dict, contamination_df: pandas.DataFrame, parameters: list, pixel_numbers,
+                   scenario: str = '') -> list:
+    """
+     Calculates the load and the concentration at some nodes directly from the loads of the discharge points and the
+     travel time index of add_travel_time_index, without propagating the network. The attenuation may be a list, in
+     which case all attenuations are evaluated at once, e.g. for a sweep during calibration.
+     :rtype: list
+     :network: dict: the network with the travel time index of the scenario and its discharge field.
+     :contamination_df: pandas.DataFrame: A dataframe of contamination containing the discharge points.
+     :parameters: list: A list of the parameters in the model, including excretion, attenuation, filtered efficacy,
+                        primary efficacy, secondary efficacy and tertiary efficacy. The attenuation may be a list.
+     :pixel_numbers: array-like: the nodes of interest.
+     :scenario: string: the scenario to be run. The default gives the hydroRIVERS scenario.
+     :return: the load and the concentration of the requested nodes, with a column for every attenuation if the
+     attenuation is a list. They equal the results of run_model up to rounding.
+     """
+    cont, RT, dis, rel_cont = scenario_fields(scenario)
+    travel_time = network['travel_time_' + RT]
+    preorder = network['preorder']
+    attenuation = numpy.asarray(parameters[1], dtype=numpy.float64)
+    nodes = pixels_to_index(network, pixel_numbers)
+
+    # the discharge points in depth-first order, such that the sources upstream of a node are a contiguous range
+    source = table_to_index(network, contamination_df)
+    source_load = plant_loads(contamination_df, parameters)
+    order = numpy.argsort(preorder[source], kind='stable')
+    source = source[order]
+    source_load = source_load[order]
+    first = numpy.searchsorted(preorder[source], preorder[nodes], side='left')
+    last = numpy.searchsorted(preorder[source], preorder[nodes] + network['upstream_count'][nodes], side='left')
+
+    # every pair of a node and a source upstream of it
+    pair_count = last - first
+    pair_node = numpy.repeat(numpy.arange(len(nodes)), pair_count)
+    pair_source = numpy.arange(pair_count.sum()) - numpy.repeat(numpy.cumsum(pair_count) - pair_count, pair_count) + \
+        numpy.repeat(first, pair_count)
+    path_time = travel_time[source[pair_source]] - travel_time[nodes[pair_node]] + network[RT][nodes[pair_node]]
+    contribution = source_load[pair_source].reshape((-1,) + (1,) * attenuation.ndim) * \
+        numpy.exp(-numpy.multiply.outer(path_time, attenuation))
+
+    load = numpy.zeros((len(nodes),) + attenuation.shape)
+    numpy.add.at(load, pair_node, contribution)
+    return [load, load / network[dis][nodes].reshape((-1,) + (1,) * attenuation.ndim)]
+
+
+def network_to_graph(river_graph: networkx.DiGraph, network: dict, fields: dict) -> networkx.DiGraph:
+    """
+     Writes arrays that follow the node order of a network to the nodes of a river graph.
+     :rtype: networkx.DiGraph
+     :river_graph: networkx.DiGraph: the river graph to which the fields are written.
+     :network: dict: the network created by graph_to_network.
+     :fields: dict: field names as keys and arrays as values.
+     :return: the river graph with the additional fields.
+     """
+    pixel_number = network['pixel_number'].tolist()
+    for field_name, values in fields.items():
+        networkx.set_node_attributes(river_graph, dict(zip(pixel_number, numpy.asarray(values).tolist())),
+                                     field_name)
+    return river_graph
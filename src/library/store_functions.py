@@ -0,0 +1,410 @@
+import os
+import sys
+import numpy
+import pandas
+import networkx
+import src.library.network_functions as network_functions
+
+topology_fields = ['pixel_number', 'child', 'parent_pointer', 'parent_index', 'level_pointer', 'sorted_pixel_number',
+                   'sorted_index']
+# the arrays of network_functions.add_travel_time_index, besides the 'travel_time_' + residence time fields. Like the
+# topology they are not node attributes, but unlike the topology a store does not need to have them.
+index_fields = ['preorder', 'upstream_count']
+
+# the dtypes of the node attributes of "3. shapefile to graph". The discharges and residence times are inputs of the
+# model and stay float64, such that a run from the store equals a run from the graph. Descriptive attributes get
+# float32, which keeps about 7 significant digits. Attributes that are not listed get float64 if they are a discharge
+# or residence time (a name starting with 'flow' or 'RT_', as in network_functions.scenario_fields), float32 if they
+# are other floats and int64 if they are integers.
+node_dtypes = {'x': numpy.int32, 'y': numpy.int32, 'longitude': numpy.float64, 'latitude': numpy.float64,
+               'slope': numpy.float32, 'lakes': numpy.int32, 'volume': numpy.float32, 'flow_HR': numpy.float64,
+               'HYRIV_ID': numpy.int64, 'cell_distance': numpy.float32, 'RT_HR': numpy.float64, 'basin': numpy.int32}
+
+
+def write_results(directory: str, pixel_number, fields: dict, chunk_size: int = 1000000) -> None:
+    """
+     Writes model results as columns keyed by pixel number, instead of pickling the annotated river graph. The nodes
+     are sorted by pixel number and written in compressed chunks, such that a single field or a range of pixels can be
+     read back without loading everything, see read_results.
+     :rtype: None
+     :directory: str: the directory of the results. It is created if it does not exist. Earlier results in it are
+     replaced.
+     :pixel_number: array-like: the pixel number of every node, e.g. network['pixel_number'].
+     :fields: dict: field names as keys and arrays with a value for every node as values, e.g. {"absolute load": load,
+     "concentration": concentration}.
+     :chunk_size: int: the amount of nodes per chunk.
+     :return: None
+     """
+    pixel_number = numpy.asarray(pixel_number, dtype=numpy.int64)
+    for field_name, values in fields.items():
+        if len(values) != len(pixel_number):
+            raise ValueError('The field ' + field_name + ' does not have a value for every pixel number')
+    os.makedirs(directory, exist_ok=True)
+    for file_name in os.listdir(directory):
+        if file_name.startswith('chunk_') and file_name.endswith('.npz'):
+            os.remove(os.path.join(directory, file_name))
+
+    order = numpy.argsort(pixel_number, kind='stable')
+    starts = range(0, len(order), chunk_size)
+    first_pixel = []
+    last_pixel = []
+    for chunk, start in enumerate(starts):
+        index = order[start:start + chunk_size]
+        chunk_fields = {field_name: numpy.asarray(values)[index] for field_name, values in fields.items()}
+        numpy.savez_compressed(os.path.join(directory, chunk_name(chunk)), pixel_number=pixel_number[index],
+                               **chunk_fields)
+        first_pixel.append(pixel_number[index[0]])
+        last_pixel.append(pixel_number[index[-1]])
+
+    numpy.savez(os.path.join(directory, 'index.npz'), first_pixel=numpy.array(first_pixel, dtype=numpy.int64),
+                last_pixel=numpy.array(last_pixel, dtype=numpy.int64), field_names=numpy.array(list(fields), dtype=str))
+
+
+def read_results(directory: str, field_names: list = None, pixel_numbers=None) -> pandas.DataFrame:
+    """
+     Reads model results written by write_results. Only the chunks that contain the requested pixels and only the
+     requested fields are decompressed.
+     :rtype: pandas.DataFrame
+     :directory: str: the directory of the results.
+     :field_names: list: the fields to read. Defaults to all fields.
+     :pixel_numbers: array-like: the pixel numbers to read. Defaults to all pixels. Pixels without results are left
+     out.
+     :return: a dataframe with the pixel numbers as index and a column for every field.
+     """
+    with numpy.load(os.path.join(directory, 'index.npz')) as index:
+        first_pixel = index['first_pixel']
+        last_pixel = index['last_pixel']
+        stored_field_names = index['field_names'].tolist()
+    if field_names is None:
+        field_names = stored_field_names
+    missing = set(field_names).difference(stored_field_names)
+    if missing:
+        raise KeyError('Some fields are not in the results, e.g. ' + str(next(iter(missing))))
+
+    chunks = range(len(first_pixel))
+    if pixel_numbers is not None:
+        pixel_numbers = numpy.unique(numpy.asarray(pixel_numbers, dtype=numpy.int64))
+        # a chunk is needed if any requested pixel lies between its first and last pixel
+        needed = numpy.searchsorted(pixel_numbers, last_pixel, side='right') > \
+            numpy.searchsorted(pixel_numbers, first_pixel, side='left')
+        chunks = numpy.flatnonzero(needed)
+
+    frames = []
+    for chunk in chunks:
+        with numpy.load(os.path.join(directory, chunk_name(chunk))) as data:
+            pixel_number = data['pixel_number']
+            selection = slice(None)
+            if pixel_numbers is not None:
+                selection = numpy.isin(pixel_number, pixel_numbers)
+            frames.append(pandas.DataFrame({field_name: data[field_name][selection] for field_name in field_names},
+                                           index=pixel_number[selection]))
+
+    if len(frames) == 0:
+        return pandas.DataFrame(columns=field_names, index=pandas.Index([], dtype=numpy.int64))
+    results = pandas.concat(frames)
+    results.index.name = 'pixel_number'
+    return results
+
+
+def chunk_name(chunk: int) -> str:
+    """
+     Gives the file name of a chunk of results.
+     :rtype: str
+     :chunk: int: the number of the chunk.
+     :return: the file name.
+     """
+    return 'chunk_' + str(chunk).zfill(5) + '.npz'
+
+
+def attribute_fields(field_names) -> list:
+    """
+     Gives the node attributes among field names, leaving out the topology and the travel time index.
+     :rtype: list
+     :field_names: iterable: field names, e.g. a network.
+     :return: a list with the field names that are node attributes.
+     """
+    return [field_name for field_name in field_names if field_name not in topology_fields and
+            field_name not in index_fields and not field_name.startswith('travel_time_')]
+
+
+def graph_to_node_table(river_graph: networkx.DiGraph, attribute_names: list = None, sorted_river_list: list = None,
+                        dtypes: dict = None) -> dict:
+    """
+     Converts a river graph to a node table: the network of network_functions.graph_to_network with an array of an
+     explicit dtype for every node attribute, instead of a python dictionary with boxed values for every node. Use
+     NodeTable for graph-like access and memory_report to compare the memory use.
+     :rtype: dict
+     :river_graph: networkx.DiGraph: the river graph. Every node may have at most one child.
+     :attribute_names: list: the node attributes to convert. Defaults to all attributes of the nodes.
+     :sorted_river_list: list: the nodes to include, preferably in topological order. Defaults to all nodes.
+     :dtypes: dict: dtypes that override node_dtypes, e.g. {'slope': numpy.float64}.
+     :return: the network with an array for every attribute.
+     """
+    network = network_functions.graph_to_network(river_graph, sorted_river_list, [])
+    if attribute_names is None:
+        attribute_names = []
+        for node, data in river_graph.nodes(data=True):
+            attribute_names.extend(name for name in data if name not in attribute_names)
+    dtypes = {**node_dtypes, **(dtypes or {})}
+
+    for attribute_name in attribute_names:
+        values = numpy.array([river_graph.nodes[node][attribute_name] for node in network['pixel_number'].tolist()])
+        if values.dtype == object:
+            raise TypeError('The attribute ' + attribute_name + ' cannot be stored as a numpy array')
+        if attribute_name in dtypes:
+            values = values.astype(dtypes[attribute_name])
+        elif values.dtype.kind in 'fiu' and attribute_name.startswith(('flow', 'RT_')):
+            values = values.astype(numpy.float64)
+        elif values.dtype.kind == 'f':
+            values = values.astype(numpy.float32)
+        elif values.dtype.kind in 'iu':
+            values = values.astype(numpy.int64)
+        network[attribute_name] = values
+    return network
+
+
+def graph_to_store(river_graph: networkx.DiGraph, directory: str, attribute_names: list = None,
+                   sorted_river_list: list = None) -> dict:
+    """
+     Writes a river graph to a model store: a directory with one .npy file for every array of the node table of
+     graph_to_node_table. Unlike a pickled graph, single attributes can be opened without reading the others, see
+     load_store.
+     :rtype: dict
+     :river_graph: networkx.DiGraph: the river graph. Every node may have at most one child.
+     :directory: str: the directory of the store. It is created if it does not exist.
+     :attribute_names: list: the node attributes to write. Defaults to all attributes of the nodes.
+     :sorted_river_list: list: the nodes to include, preferably in topological order. Defaults to all nodes.
+     :return: the node table, as written to the store.
+     """
+    network = graph_to_node_table(river_graph, attribute_names, sorted_river_list)
+    network_to_store(network, directory)
+    return network
+
+
+def network_to_store(network: dict, directory: str) -> None:
+    """
+     Writes every array of a network to a model store, see graph_to_store.
+     :rtype: None
+     :network: dict: the network created by network_functions.graph_to_network.
+     :directory: str: the directory of the store. It is created if it does not exist.
+     :return: None
+     """
+    os.makedirs(directory, exist_ok=True)
+    for field_name, values in network.items():
+        numpy.save(os.path.join(directory, field_name + '.npy'), numpy.asarray(values))
+
+
+def store_fields(directory: str) -> list:
+    """
+     Gives the node attributes that are available in a model store.
+     :rtype: list
+     :directory: str: the directory of the store.
+     :return: a list with the names of the attributes, without the topology and the travel time index.
+     """
+    return sorted(attribute_fields(file_name[:-4] for file_name in os.listdir(directory) if file_name.endswith('.npy')))
+
+
+def load_store(directory: str, attribute_names: list = None, mmap_mode: str = 'r') -> dict:
+    """
+     Opens a model store as a network. The arrays are memory mapped, so only the parts that are used are read from the
+     disk.
+     :rtype: dict
+     :directory: str: the directory of the store.
+     :attribute_names: list: the node attributes to open besides the topology. Defaults to all attributes.
+     :mmap_mode: str: the mmap_mode of numpy.load. Use None to read the arrays into memory.
+     :return: the network with the topology arrays, the travel time index if the store has it and the attributes.
+     """
+    if attribute_names is None:
+        attribute_names = store_fields(directory)
+    index_names = [file_name[:-4] for file_name in sorted(os.listdir(directory)) if file_name.endswith('.npy') and
+                   (file_name[:-4] in index_fields or file_name.startswith('travel_time_'))]
+    network = {}
+    for field_name in topology_fields + list(attribute_names):
+        location = os.path.join(directory, field_name + '.npy')
+        if not os.path.isfile(location):
+            raise AttributeError('the attribute ' + field_name + ' is not in the store')
+        network[field_name] = numpy.load(location, mmap_mode=mmap_mode)
+    for field_name in index_names:
+        network[field_name] = numpy.load(os.path.join(directory, field_name + '.npy'), mmap_mode=mmap_mode)
+    return network
+
+
+def add_to_store(directory: str, fields: dict, pixel_numbers=None) -> None:
+    """
+     Adds fields to a model store, or updates them. Every field is a single file, so the rest of the store is not
+     rewritten.
+     :rtype: None
+     :directory: str: the directory of the store.
+     :fields: dict: field names as keys and arrays as values.
+     :pixel_numbers: array-like: the pixel numbers of the values. If None, the values must follow the node order of the
+     store. Otherwise, only these nodes are updated and new fields are NaN for the other nodes.
+     :return: None
+     """
+    network = load_store(directory, [])
+    node_count = len(network['pixel_number'])
+    if pixel_numbers is not None:
+        index = network_functions.pixels_to_index(network, pixel_numbers)
+
+    for field_name, values in fields.items():
+        if field_name in topology_fields:
+            raise ValueError('The topology of the store cannot be changed: ' + field_name)
+        if not attribute_fields([field_name]):
+            raise ValueError('The travel time index follows from the topology, use network_to_store: ' + field_name)
+        values = numpy.asarray(values)
+        location = os.path.join(directory, field_name + '.npy')
+        if pixel_numbers is not None:
+            if os.path.isfile(location):
+                field = numpy.load(location)
+                field = field.astype(numpy.result_type(field, values))
+            elif len(numpy.unique(index)) == node_count:  # a new field for every node keeps its data type
+                field = numpy.empty(node_count, dtype=values.dtype)
+            else:
+                field = numpy.full(node_count, numpy.nan, dtype=numpy.result_type(values, numpy.float64))
+            field[index] = values
+            values = field
+        if len(values) != node_count:
+            raise ValueError('The field ' + field_name + ' does not have a value for every node of the store')
+        numpy.save(location + '.tmp.npy', values)
+        os.replace(location + '.tmp.npy', location)
+
+
+def store_to_graph(directory: str, attribute_names: list = None) -> networkx.DiGraph:
+    """
+     Creates a river graph from a model store, for functions that need a networkx graph.
+     :rtype: networkx.DiGraph
+     :directory: str: the directory of the store.
+     :attribute_names: list: the node attributes of the graph. Defaults to all attributes.
+     :return: a river graph with the nodes and edges of the store and the requested attributes.
+     """
+    network = load_store(directory, attribute_names)
+    pixel_number = network['pixel_number']
+    child = network['child']
+    river_graph = networkx.DiGraph()
+    river_graph.add_nodes_from(pixel_number.tolist())
+    river_graph.add_edges_from(zip(pixel_number[child >= 0].tolist(), pixel_number[child[child >= 0]].tolist()))
+    network_functions.network_to_graph(river_graph, network, {attribute_name: network[attribute_name]
+                                                              for attribute_name in attribute_fields(network)})
+    return river_graph
+
+
+class NodeTable:
+    """
+     Gives graph-like access to a node table of graph_to_node_table or load_store, such that code written for the
+     river graph, e.g. table.nodes[pixel_number]['flow_HR'], keeps working on the arrays.
+     """
+
+    def __init__(self, network: dict):
+        self.network = network
+        self.nodes = NodeView(network)
+
+    def __contains__(self, pixel_number) -> bool:
+        return network_functions.pixels_to_index(self.network, [pixel_number], missing=-1)[0] >= 0
+
+    def __iter__(self):
+        return iter(self.network['pixel_number'].tolist())
+
+    def __len__(self) -> int:
+        return len(self.network['pixel_number'])
+
+    def number_of_nodes(self) -> int:
+        return len(self)
+
+    def successors(self, pixel_number):
+        child = self.network['child'][network_functions.pixels_to_index(self.network, [pixel_number])[0]]
+        return iter(self.network['pixel_number'][child:child + 1].tolist() if child >= 0 else [])
+
+    def predecessors(self, pixel_number):
+        index = network_functions.pixels_to_index(self.network, [pixel_number])[0]
+        parents = self.network['parent_index'][self.network['parent_pointer'][index]:
+                                               self.network['parent_pointer'][index + 1]]
+        return iter(self.network['pixel_number'][parents].tolist())
+
+
+class NodeView:
+    """
+     The nodes of a NodeTable: view[pixel_number] gives the attributes of a node.
+     """
+
+    def __init__(self, network: dict):
+        self.network = network
+        self.attribute_names = attribute_fields(network)
+
+    def __getitem__(self, pixel_number):
+        return NodeAttributes(self, network_functions.pixels_to_index(self.network, [pixel_number])[0])
+
+    def __contains__(self, pixel_number) -> bool:
+        return network_functions.pixels_to_index(self.network, [pixel_number], missing=-1)[0] >= 0
+
+    def __iter__(self):
+        return iter(self.network['pixel_number'].tolist())
+
+    def __len__(self) -> int:
+        return len(self.network['pixel_number'])
+
+
+class NodeAttributes:
+    """
+     The attributes of a single node of a NodeTable. Values are read from and written to the arrays of the table, in
+     their dtype.
+     """
+
+    def __init__(self, view: NodeView, index: int):
+        self.view = view
+        self.index = index
+
+    def __getitem__(self, attribute_name):
+        if attribute_name not in self.view.attribute_names:
+            raise KeyError(attribute_name)
+        return self.view.network[attribute_name][self.index].item()
+
+    def __setitem__(self, attribute_name, value):
+        if attribute_name not in self.view.attribute_names:
+            raise KeyError('New attributes must be added to the whole table: ' + str(attribute_name))
+        self.view.network[attribute_name][self.index] = value
+
+    def __contains__(self, attribute_name) -> bool:
+        return attribute_name in self.view.attribute_names
+
+    def __iter__(self):
+        return iter(self.view.attribute_names)
+
+    def __len__(self) -> int:
+        return len(self.view.attribute_names)
+
+    def get(self, attribute_name, default=None):
+        return self[attribute_name] if attribute_name in self else default
+
+    def keys(self) -> list:
+        return list(self.view.attribute_names)
+
+    def items(self) -> list:
+        return [(attribute_name, self[attribute_name]) for attribute_name in self.view.attribute_names]
+
+
+def memory_report(river_graph: networkx.DiGraph, network: dict) -> pandas.DataFrame:
+    """
+     Compares the memory use of a river graph with the memory use of its node table. The graph is measured with
+     sys.getsizeof of the node and adjacency dictionaries, their keys and their values, so shared objects such as
+     small integers are counted more than once and the result is an estimate.
+     :rtype: pandas.DataFrame
+     :river_graph: networkx.DiGraph: the river graph.
+     :network: dict: the node table of graph_to_node_table.
+     :return: a dataframe with the bytes of the graph, of the table and the bytes saved, per attribute and in total.
+     The structure of the graph is reported as 'topology'.
+     """
+    attribute_names = attribute_fields(network)
+    graph_bytes = dict.fromkeys(['topology'] + attribute_names, 0)
+    for node, data in river_graph.nodes(data=True):
+        graph_bytes['topology'] += sys.getsizeof(node) + sys.getsizeof(data) + \
+            sys.getsizeof(river_graph.succ[node]) + sys.getsizeof(river_graph.pred[node])
+        for attribute_name, value in data.items():
+            if attribute_name in graph_bytes:
+                graph_bytes[attribute_name] += sys.getsizeof(value)
+    table_bytes = {'topology': sum(network[field_name].nbytes for field_name in network
+                                   if field_name not in attribute_names)}
+    table_bytes.update({attribute_name: network[attribute_name].nbytes for attribute_name in attribute_names})
+
+    report = pandas.DataFrame({'graph bytes': pandas.Series(graph_bytes), 'table bytes': pandas.Series(table_bytes)})
+    report.loc['total'] = report.sum()
+    report['saved bytes'] = report['graph bytes'] - report['table bytes']
+    return report
@@ -1,21 +1,13 @@
 import numpy
-import math
 import networkx
 
+from src.library import network_functions
+
 
 def simulated_contaminants(filtered_efficacy, secondary_efficacy, tertiary_efficacy, k_dec, b_0, river_graph,
                            sorted_river_list, contamination_df, scenario_number, datapoint_locations):
-
-    # contamination
-    treatment_efficacy = 0.3 * (contamination_df["Treatment_level"] == 1) + secondary_efficacy * \
-                         (contamination_df["Treatment_level"] == 2) + tertiary_efficacy * \
-                         (contamination_df["Treatment_level"] == 3)
-    # formula
-    contamination = (1 - treatment_efficacy) * contamination_df["Treat_a"] + (1 - filtered_efficacy)\
-                    * contamination_df["Filt_a"] + contamination_df["Unfilt_a"]
-    contamination *= contamination_df["pollution"]*b_0
-    location = contamination_df["pixel_number"]
-
+    # river_graph may also be a network created by network_functions.graph_to_network, which avoids converting the
+    # graph at every call. In that case nothing is written to a graph.
     cont = "Contaminant " + scenario_number
     RT = "RT_" + scenario_number
     dis = scenario_number
@@ -26,25 +18,38 @@ def simulated_contaminants(filtered_efficacy, secondary_efficacy, tertiary_effic
         RT = "RT_HR"
         dis = "flow_HR"
         rel_cont = "Relative Contaminant"
-    networkx.set_node_attributes(river_graph, 0, name=cont)
-
-    for i in range(len(contamination_df)):
-        pixel_number = location[i]
-        river_graph.nodes[pixel_number][cont] += contamination[i]
-
-    for n in sorted_river_list:  # for all river pixels
-        # Add the contamination of the parent cells
-        parents = list(river_graph.predecessors(n))
-        for k in parents:
-            river_graph.nodes[n][cont] += river_graph.nodes[k][cont]
-
-        river_graph.nodes[n][cont] *= math.exp((-k_dec * river_graph.nodes[n][RT]))
-        river_graph.nodes[n][rel_cont] = river_graph.nodes[n][cont] / river_graph.nodes[n][dis]
-    results = numpy.zeros([len(datapoint_locations)])
-    discharges = numpy.zeros([len(datapoint_locations)])
-    for i in range(len(datapoint_locations)):
-        results[i] = river_graph.nodes[datapoint_locations[i]][rel_cont]
-        discharges[i] = river_graph.nodes[datapoint_locations[i]][dis]
+
+    if isinstance(river_graph, networkx.DiGraph):
+        network = network_functions.graph_to_network(river_graph, sorted_river_list, [RT, dis])
+    else:
+        network = river_graph
+
+    # contamination
+    parameters = [b_0, k_dec, filtered_efficacy, 0.3, secondary_efficacy, tertiary_efficacy]
+    contamination = network_functions.plant_loads(contamination_df, parameters)
+    initial_load = network_functions.initial_loads(network, contamination_df, contamination)
+
+    load = network_functions.propagate(network, initial_load, numpy.exp(-k_dec * network[RT]))
+    concentration = load / network[dis]
+    if isinstance(river_graph, networkx.DiGraph):
+        network_functions.network_to_graph(river_graph, network, {cont: load, rel_cont: concentration})
+
+    datapoint_index = network_functions.pixels_to_index(network, datapoint_locations)
+    results = concentration[datapoint_index]
+    discharges = network[dis][datapoint_index]
+
+    return results, discharges
+
+
+def simulated_contaminants_batch(parameter_matrix, network, contamination_df, scenario_number, datapoint_locations):
+    # runs all rows [excretion, attenuation, filt_eff, primary_eff, secondary_eff, tertiary_eff] of parameter_matrix at
+    # once. network is created by network_functions.graph_to_network. Results have a column per parameter vector.
+    load, concentration = network_functions.run_model_batch(network, contamination_df, parameter_matrix,
+                                                            scenario_number)
+    dis = network_functions.scenario_fields(scenario_number)[2]
+    datapoint_index = network_functions.pixels_to_index(network, datapoint_locations)
+    results = concentration[datapoint_index]
+    discharges = network[dis][datapoint_index]
 
     return results, discharges
 